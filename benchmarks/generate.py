@@ -0,0 +1,137 @@
+import os
+import sys
+import random
+import argparse
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metatiled import palettes, palettes_to_8bit_rgb, split_into_blocks  # noqa: E402
+
+
+collision_colors = {
+    'FLOOR': (0x00, 0xae, 0xff),
+    'WALL': (0x00, 0xff, 0x15),
+    'WATER': (0xff, 0x00, 0xb3)
+}
+
+
+def generate_tiles(rnd, count, colors, flip_density):
+    '''Random tiles using every tone of one color each, plus flipped copies.'''
+    tiles = []
+    for _ in range(count):
+        tones = np.array(rnd.choice(colors), dtype=np.uint8)
+        # All the tones are used so every tile matches a single color
+        shades = [0, 1, 2, 3] + [rnd.randrange(4) for _ in range(60)]
+        rnd.shuffle(shades)
+        tiles.append(tones[np.array(shades).reshape(8, 8)])
+
+    flipped_tiles = []
+    for _ in range(round(count * flip_density)):
+        tile = rnd.choice(tiles)
+        flip = rnd.choice((np.fliplr, np.flipud, lambda t: np.flipud(np.fliplr(t))))
+        flipped_tiles.append(flip(tile))
+
+    return tiles + flipped_tiles
+
+
+def generate_map(width, height, unique_ratio=0.2, colors=5, flip_density=0.25,
+                 tiles=96, palette_name='day', seed=0, layout_seed=None):
+    '''Synthetic map of width x height metatiles as an RGB array.
+
+    unique_ratio is the fraction of metatiles of the map that are different.
+    It's capped at 254 unique metatiles (the border metatile takes one more)
+    since .blk files store metatile indexes as bytes.
+
+    Maps with the same seed share their tiles; layout_seed (defaults to seed)
+    changes how they are arranged into metatiles and metatiles into the map.
+    '''
+    if tiles * (1 + flip_density) > 250:
+        raise SystemExit('[Error] Too many tiles. Limit is 250 including flips.')
+
+    rnd = random.Random(seed)
+    palette = palettes_to_8bit_rgb(palettes)[palette_name]
+    palette_colors = [tones for color_name, tones in palette.items()
+                      if color_name != 'TEXT'][:colors]
+
+    tile_pool = generate_tiles(rnd, tiles, palette_colors, flip_density)
+    if layout_seed is not None:
+        rnd = random.Random(layout_seed)
+
+    cells = width * height
+    unique_count = min(254, cells, max(1, round(cells * unique_ratio)))
+    metatiles = []
+    for _ in range(unique_count):
+        metatile = np.empty((32, 32, 3), dtype=np.uint8)
+        metatile_tiles = split_into_blocks(metatile, 8)
+        for y in range(4):
+            for x in range(4):
+                metatile_tiles[y, x] = rnd.choice(tile_pool)
+        metatiles.append(metatile)
+
+    # Every unique metatile appears at least once
+    layout = list(range(unique_count)) + [rnd.randrange(unique_count)
+                                          for _ in range(cells - unique_count)]
+    rnd.shuffle(layout)
+
+    pixels = np.empty((height * 32, width * 32, 3), dtype=np.uint8)
+    map_metatiles = split_into_blocks(pixels, 32)
+    for i, metatile_index in enumerate(layout):
+        map_metatiles[i // width, i % width] = metatiles[metatile_index]
+    return pixels
+
+
+def save_collision_files(image_path, width, height, seed=0):
+    '''Collision mask and txt file with the [COLLISIONS] section.'''
+    rnd = random.Random(seed)
+    colors = list(collision_colors.values())
+    cells = np.array([rnd.choice(colors) for _ in range(width * height * 4)],
+                     dtype=np.uint8).reshape(height * 2, width * 2, 3)
+    mask = cells.repeat(16, axis=0).repeat(16, axis=1)
+    Image.fromarray(mask).save(image_path.replace('.png', '_collision.png'))
+
+    with open(image_path.replace('.png', '.txt'), 'w') as f:
+        f.write('[COLLISIONS]\n\n')
+        for collision_name, color in collision_colors.items():
+            f.write(f'{collision_name}, {color[0]:02x}{color[1]:02x}{color[2]:02x}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic map (PNG) for benchmarks.')
+    parser.add_argument('output', type=str,
+                        help='Path of the map image file (PNG).')
+    parser.add_argument('--width', type=int, default=64,
+                        help='Width in metatiles.')
+    parser.add_argument('--height', type=int, default=64,
+                        help='Height in metatiles.')
+    parser.add_argument('--unique-ratio', type=float, default=0.2,
+                        help='Fraction of different metatiles (max. 254).')
+    parser.add_argument('--colors', type=int, default=5,
+                        help='Number of palette colors used (1-7).')
+    parser.add_argument('--flip-density', type=float, default=0.25,
+                        help='Flipped tiles added per base tile.')
+    parser.add_argument('--tiles', type=int, default=96,
+                        help='Number of base tiles.')
+    parser.add_argument('--palette', type=str, default='day',
+                        help='Palette the colors are taken from.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator.')
+    parser.add_argument('--layout-seed', type=int,
+                        help='Seed of the layout (maps with the same seed share tiles).')
+    parser.add_argument('--collision', action='store_true',
+                        help='Also generate a collision mask and its txt file.')
+
+    args = parser.parse_args()
+
+    pixels = generate_map(args.width, args.height, args.unique_ratio, args.colors,
+                          args.flip_density, args.tiles, args.palette, args.seed,
+                          args.layout_seed)
+    Image.fromarray(pixels).save(args.output)
+    if args.collision:
+        save_collision_files(args.output, args.width, args.height, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import numpy as np
+import PIL
+from PIL import Image
+
+from generate import generate_map, save_collision_files
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Command line arguments of every conversion path (the map is added later)
+cases = {
+    'blk': [],
+    'ablk': ['--compress'],
+    'analyze': ['--analyze-palette'],
+    'extract': ['--extract-palette']
+}
+
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_workdir(workdir):
+    '''The program writes next to itself, so every run uses a copy.'''
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(os.path.join(workdir, 'in'))
+    shutil.copy(os.path.join(repo_dir, 'metatiled.py'), workdir)
+
+
+def save_map(workdir, name, size, options, seed, layout_seed=None, collision=False):
+    map_path = os.path.join(workdir, 'in', f'{name}.png')
+    pixels = generate_map(size, size, seed=seed, layout_seed=layout_seed, **options)
+    Image.fromarray(pixels).save(map_path)
+    if collision:
+        save_collision_files(map_path, size, size, seed)
+    return os.path.relpath(map_path, workdir)
+
+
+def time_command(workdir, args):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, 'metatiled.py'] + args, cwd=workdir,
+                             capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise SystemExit(f'[Error] metatiled.py {" ".join(args)} failed:\n{process.stderr}')
+    return elapsed
+
+
+def benchmark_case(root_dir, case_name, size, options, repeat, seed):
+    workdir = os.path.join(root_dir, f'{case_name}_{size}')
+    timings = []
+    for _ in range(repeat):
+        prepare_workdir(workdir)
+        map_path = save_map(workdir, 'map', size, options, seed)
+        timings.append(time_command(workdir, [map_path] + cases[case_name]))
+    return timings
+
+
+def benchmark_merge(root_dir, size, options, repeat, seed, maps=3, compress=False):
+    '''Time --merge alone, after converting several maps sharing their tiles.'''
+    workdir = os.path.join(root_dir, f'merge_{"ablk" if compress else "blk"}_{size}')
+    flags = ['--compress'] if compress else []
+    timings = []
+    for _ in range(repeat):
+        prepare_workdir(workdir)
+        for i in range(maps):
+            # Same tiles, different layouts
+            map_path = save_map(workdir, f'map_{i}', size, options, seed,
+                                layout_seed=seed + i, collision=True)
+            time_command(workdir, [map_path] + flags)
+        timings.append(time_command(workdir, ['--merge'] + flags))
+    return timings
+
+
+def summarize(timings):
+    return {
+        'runs': timings,
+        'min': min(timings),
+        'median': statistics.median(timings)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the main conversion paths on synthetic maps.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 128],
+                        help='Map sizes (width and height in metatiles).')
+    parser.add_argument('--unique-ratio', type=float, default=0.2,
+                        help='Fraction of different metatiles (max. 254).')
+    parser.add_argument('--colors', type=int, default=5,
+                        help='Number of palette colors used (1-7).')
+    parser.add_argument('--flip-density', type=float, default=0.25,
+                        help='Flipped tiles added per base tile.')
+    parser.add_argument('--tiles', type=int, default=96,
+                        help='Number of base tiles.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of every case.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator.')
+    parser.add_argument('--cases', type=str, nargs='+',
+                        default=list(cases) + ['merge_blk', 'merge_ablk'],
+                        help='Cases to run.')
+    parser.add_argument('--output', '-o', type=str,
+                        default=os.path.join(repo_dir, 'benchmarks', 'results.json'),
+                        help='Path of the JSON file with the results.')
+
+    args = parser.parse_args()
+
+    options = {
+        'unique_ratio': args.unique_ratio,
+        'colors': args.colors,
+        'flip_density': args.flip_density,
+        'tiles': args.tiles
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='metatiled-bench-') as root_dir:
+        for size in args.sizes:
+            for case_name in args.cases:
+                if case_name in cases:
+                    timings = benchmark_case(
+                        root_dir, case_name, size, options, args.repeat, args.seed)
+                elif case_name in ('merge_blk', 'merge_ablk'):
+                    # ? Merging overflows the metatile indexes with too many unique metatiles
+                    merge_options = dict(options, unique_ratio=min(
+                        options['unique_ratio'], 80 / (size * size)))
+                    timings = benchmark_merge(root_dir, size, merge_options, args.repeat,
+                                              args.seed, compress=case_name == 'merge_ablk')
+                else:
+                    raise SystemExit(f'[Error] Unknown case {case_name}.')
+
+                result = dict(case=case_name, size=size, **summarize(timings))
+                results.append(result)
+                print(f'{case_name:<12}{size:>5}x{size:<5}'
+                      f'{result["min"] * 1000:>10.1f} ms (min){result["median"] * 1000:>10.1f} ms (median)')
+
+    report = {
+        'revision': get_revision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'options': dict(options, repeat=args.repeat, seed=args.seed),
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,108 @@
+import io
 import os
+import sys
+import glob
+import json
+import mmap
+import stat
+import zlib
+import base64
+import time
+import hashlib
 import shutil
+import struct
 import colorsys
 import argparse
-from PIL import Image, ImageOps, ImageDraw
+import socketserver
+import http.server
+import functools
+import contextlib
+import tracemalloc
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+# PROFILE ---------------------------------------------------------------------
+
+# Stage timings and counters, only collected after calling enable_profile()
+profile_stats = None
+profile_frames = []  # Peak memory of the stages currently running
+
+
+def enable_profile():
+    global profile_stats
+    profile_stats = {'stages': {}, 'counters': {}}
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def count(counter_name, amount=1):
+    if profile_stats is not None:
+        counters = profile_stats['counters']
+        counters[counter_name] = counters.get(counter_name, 0) + amount
+
+
+def profiled(function):
+    '''Record wall time and peak memory of every call as a stage.'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if profile_stats is None:
+            return function(*args, **kwargs)
+
+        # Keep the peak reached so far by the outer stages before resetting it
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        for frame in profile_frames:
+            frame['peak'] = max(frame['peak'], peak_memory)
+        tracemalloc.reset_peak()
+        frame = {'start': current_memory, 'peak': 0}
+        profile_frames.append(frame)
+
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            profile_frames.pop()
+            peak_memory = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            stage = profile_stats['stages'].setdefault(
+                function.__name__, {'calls': 0, 'time': 0.0, 'peak_memory': 0})
+            stage['calls'] += 1
+            stage['time'] += elapsed
+            stage['peak_memory'] = max(
+                stage['peak_memory'], peak_memory - frame['start'])
+    return wrapper
+
+
+def merge_profile(stats, other_stats):
+    for stage_name, other_stage in other_stats['stages'].items():
+        stage = stats['stages'].setdefault(
+            stage_name, {'calls': 0, 'time': 0.0, 'peak_memory': 0})
+        stage['calls'] += other_stage['calls']
+        stage['time'] += other_stage['time']
+        stage['peak_memory'] = max(
+            stage['peak_memory'], other_stage['peak_memory'])
+    for counter_name, amount in other_stats['counters'].items():
+        stats['counters'][counter_name] = stats['counters'].get(
+            counter_name, 0) + amount
+
+
+def print_profile(stats):
+    print(f'{"Stage":<32}{"Calls":>8}{"Time (ms)":>12}{"Peak memory (KiB)":>20}')
+    for stage_name, stage in stats['stages'].items():
+        print(f'{stage_name:<32}{stage["calls"]:>8}{stage["time"] * 1000:>12.2f}'
+              f'{stage["peak_memory"] / 1024:>20.1f}')
+    if stats['counters']:
+        print()
+        print(f'{"Counter":<32}{"Count":>8}')
+        for counter_name, amount in stats['counters'].items():
+            print(f'{counter_name:<32}{amount:>8}')
+
+
+def save_profile_json_file(stats, output_path):
+    with open(output_path, 'w') as f:
+        json.dump(stats, f, indent=2)
 
 
 # COLOR -----------------------------------------------------------------------
@@ -61,16 +161,89 @@ palettes = {
 }
 
 
-def is_same_tone(tile_tone, palette_tone, tolerance=1):
-    match = all([abs(tile_tone[i] - palette_tone[i])
-                <= tolerance for i in range(3)])
-    return match
+# Palettes, tone indexes, tile classifications and the last metatiles of every map
+# kept between conversions (--serve and --watch)
+warm_cache = None
+
+# Entries kept in every cache of warm_cache (the least recently used ones are evicted)
+warm_cache_limits = {
+    'tone_indexes': 64,
+    'tiles': 16384,
+    'maps': 32
+}
+
+
+def enable_warm_cache():
+    global warm_cache
+    warm_cache = {
+        'palettes': palettes_to_8bit_rgb(palettes),
+        'tone_indexes': OrderedDict(),  # Palette key -> tone index
+        'tiles': OrderedDict(),  # (palette key, tile bytes) -> (Tile, positions of its tones)
+        # Map path -> (rows and columns, cell hashes, darkest tone, unique metatiles, metatile indexes)
+        'maps': OrderedDict()
+    }
+
+
+def get_warm(cache_name, key):
+    '''Entry of a cache of warm_cache (None if missing), marking it as recently used.'''
+    cache = warm_cache[cache_name]
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+
+def set_warm(cache_name, key, value):
+    cache = warm_cache[cache_name]
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > warm_cache_limits[cache_name]:
+        cache.popitem(last=False)
 
 
-def is_same_color(tile_tones, palette_tones):
-    match = all([any(is_same_tone(tile_tone, palette_tone)
-                for palette_tone in palette_tones) for tile_tone in tile_tones])
-    return match
+def get_palette_key(palette):
+    return tuple((color_name, tuple(map(tuple, tones))) for color_name, tones in palette.items())
+
+
+def load_palettes():
+    '''Default palettes in 8-bit RGB (built once with the warm cache, so don't modify them).'''
+    if warm_cache is None:
+        return palettes_to_8bit_rgb(palettes)
+    return warm_cache['palettes']
+
+
+def build_tone_index(palette, tolerance=1):
+    '''Map every tone within tolerance of a palette tone to the colors
+    containing it and the position of the first matching tone in each.'''
+    if warm_cache is not None:
+        palette_key = (get_palette_key(palette), tolerance)
+        tone_index = get_warm('tone_indexes', palette_key)
+        if tone_index is None:
+            tone_index = _build_tone_index(palette, tolerance)
+            set_warm('tone_indexes', palette_key, tone_index)
+        return tone_index
+    return _build_tone_index(palette, tolerance)
+
+
+def _build_tone_index(palette, tolerance):
+    tone_index = {}
+    offsets = range(-tolerance, tolerance + 1)
+    for color_name, palette_tones in palette.items():
+        for position, (r, g, b) in enumerate(palette_tones):
+            for dr in offsets:
+                for dg in offsets:
+                    for db in offsets:
+                        positions = tone_index.setdefault(
+                            (r + dr, g + dg, b + db), {})
+                        positions.setdefault(color_name, position)
+    return tone_index
+
+
+def get_tile_colors(tile_tones, tone_index):
+    '''Colors containing all the tile tones, in palette order.'''
+    tone_positions = [tone_index.get(tone, {}) for tone in tile_tones]
+    return [color_name for color_name in tone_positions[0]
+            if all(color_name in positions for positions in tone_positions[1:])]
 
 
 def convert_to_5bit_rgb(color):
@@ -114,45 +287,56 @@ def is_tile_white(tile):
     return True
 
 
-def tile_to_grayscale(tile, color_to_grays):
-    grayscale = {
-        0: (255, 255, 255),
-        1: (170, 170, 170),
-        2: (85, 85, 85),
-        3: (0, 0, 0)
-    }
-    grays = {gray: grayscale[position]
-             for gray, position in color_to_grays.items()}
-    new_tile = Image.new('RGB', (8, 8))
-    for y in range(8):
-        for x in range(8):
-            pixel = tile.getpixel((x, y))
-            new_tile.putpixel(
-                (x, y), grays.get(pixel, (255, 255, 255)))
-    return new_tile
+# 8x8 tile as Game Boy 2bpp data (16 bytes) plus the name of its palette color
+Tile = namedtuple('Tile', ['data', 'color'])
 
+grayscale_tones = np.array(
+    [(255, 255, 255), (170, 170, 170), (85, 85, 85), (0, 0, 0)], dtype=np.uint8)
 
-def tile_to_color(tile, color_to_grays):
-    grayscale = {
-        (255, 255, 255): 0,
-        (170, 170, 170): 1,
-        (85, 85, 85): 2,
-        (0, 0, 0): 3
-    }
+# Byte with its bits in reverse order (mirrors a row of 8 pixels)
+flipped_bits = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+
+def encode_tile(tile, color, color_to_grays):
+    '''Convert an RGB tile to shades and pack it as 2bpp.'''
+    # Tones that are not part of the color are treated as white
+    shades = np.zeros((8, 8), dtype=np.uint8)
+    for tone, position in color_to_grays.items():
+        shades[(tile == tone).all(axis=-1)] = position
+    planes = np.stack((shades & 1, shades >> 1), axis=1)
+    return Tile(np.packbits(planes, axis=2).tobytes(), color)
 
-    color_tile = Image.new('RGB', (8, 8))
-    for y in range(8):
-        for x in range(8):
-            gray_pixel = tile.getpixel((x, y))
-            gray_index = grayscale.get(gray_pixel, 0)
-            tone = next(key for key, value in color_to_grays.items()
-                        if value == gray_index)
-            color_tile.putpixel((x, y), tone)
-    return color_tile
+
+def decode_tile(tile):
+    '''Unpack 2bpp data to an 8x8 array of shades (0 is the lightest).'''
+    data = np.frombuffer(tile.data, dtype=np.uint8).reshape(8, 2, 1)
+    planes = np.unpackbits(data, axis=2)
+    return planes[:, 0] | (planes[:, 1] << 1)
+
+
+def flip_tile(tile, flip_x, flip_y):
+    data = tile.data
+    if flip_x:
+        data = data.translate(flipped_bits)
+    if flip_y:
+        data = b''.join(data[i:i + 2] for i in range(14, -1, -2))
+    return tile._replace(data=data)
+
+
+def tile_to_grayscale(tile):
+    return grayscale_tones[decode_tile(tile)]
+
+
+def tile_to_color(tile, color_to_grays):
+    tones = np.zeros((4, 3), dtype=np.uint8)
+    # The first tone of each shade wins
+    for tone, position in reversed(list(color_to_grays.items())):
+        tones[position] = tone
+    return tones[decode_tile(tile)]
 
 
 def get_tile_tones(tile):
-    tile_tones = set(tile.getpixel((i % 8, i // 8)) for i in range(64))
+    tile_tones = set(map(tuple, tile.reshape(-1, 3).tolist()))
     tile_tones = sort_color(tile_tones)
     return tile_tones
 
@@ -167,74 +351,87 @@ def process_partial_colors(lst):
     return unique_list
 
 
-def identify_palette(tile_color_tones, palettes):
-    palette_scores = {palette_name: 0 for palette_name in palettes}
-
+def find_palette_candidates(unique_metatiles, palettes):
+    '''Palettes containing any of the tones of the map (the rest can't match any tile).'''
+    pixels = unique_metatiles.reshape(-1, 3)
+    colors = np.unique((pixels[:, 0].astype(np.uint32) << 16) | (
+        pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2])
+
+    # ? Tones of the same index identify_palette uses, packed like the (sorted) map colors
+    candidates = []
+    for palette_name, palette_colors in palettes.items():
+        palette_tones = np.array([(r << 16) | (g << 8) | b
+                                  for r, g, b in build_tone_index(palette_colors)
+                                  if 0 <= min(r, g, b) and max(r, g, b) <= 255], dtype=np.uint32)
+        positions = np.searchsorted(colors, palette_tones).clip(max=len(colors) - 1)
+        if (colors[positions] == palette_tones).any():
+            candidates.append(palette_name)
+    count('palette candidates', len(candidates))
+    return candidates
+
+
+def identify_palette(tile_color_tones, palettes, candidates=None, log=None):
+    '''Palette matching the most tone sets (the first one if tied), or monochrome.'''
+    if candidates is None:
+        candidates = list(palettes)
+    palette_scores = {palette_name: 0 for palette_name in candidates}
+    tone_indexes = {palette_name: build_tone_index(palettes[palette_name])
+                    for palette_name in candidates}
+
+    remaining = len(tile_color_tones)
     for tile_tones in tile_color_tones:
-        for palette_name, colors in palettes.items():
-            for color_name, palette_tones in colors.items():
-                if is_same_color(tile_tones, palette_tones):
-                    palette_scores[palette_name] += 1
-                    break
+        for palette_name, tone_index in tone_indexes.items():
+            if get_tile_colors(tile_tones, tone_index):
+                palette_scores[palette_name] += 1
+        remaining -= 1
+
+        # ? Stop once no other palette can reach the leading one
+        if len(palette_scores) > 1:
+            best_score, second_score = sorted(palette_scores.values(), reverse=True)[:2]
+            if best_score - second_score > remaining:
+                break
 
     total_score = sum(palette_scores.values())
     if total_score == 0:
-        print('Palette: monochrome')
+        print('Palette: monochrome', file=log)
         return 'monochrome'
 
     palette_name = max(palette_scores, key=palette_scores.get)
-    print(f'Palette: {palette_name}')
+    print(f'Palette: {palette_name}', file=log)
 
     return palette_name
 
 
-def get_roof_colors(unique_tiles, palette):
+def get_roof_colors(unique_tile_tones, palette):
     '''For monochrome maps and roof tiles.'''
 
     if not palette.get('ROOF'):
         return
 
-    def is_roof(tile_tones, palette):
-        for color_name, palette_tones in palette.items():
-            if all(any(is_same_tone(tile_tone, palette_tone) for palette_tone in palette_tones) for tile_tone in tile_tones):
-                return False
-        return True
+    tone_index = build_tone_index(palette)
 
     roof_tones = []
-    for tile in unique_tiles:
-        tile_tones = set(tile.getpixel((i % 8, i // 8)) for i in range(64))
-        tile_tones = sort_color(tile_tones)
-        if is_roof(tile_tones, palette):
+    for tile_tones in unique_tile_tones:
+        if not get_tile_colors(tile_tones, tone_index):
             roof_tones.append(tile_tones)
 
     palette['ROOF'] = process_partial_colors(roof_tones)[0] if process_partial_colors(
         roof_tones) else palette['ROOF']
 
 
-def get_tile_palette_color(tile_tones, palette):
-    matching_positions = {}
-
-    for color_name, palette_tones in palette.items():
-        positions = {}
-        match = True
-        for i, tile_tone in enumerate(tile_tones):
-            found = False
-            for j, palette_tone in enumerate(palette_tones):
-                if is_same_tone(tile_tone, palette_tone):
-                    positions[tile_tone] = j
-                    found = True
-                    break
-            if not found:
-                match = False
-                break
-        if match:
-            matching_positions[color_name] = positions
-
-    color_name = next(iter(matching_positions))
-    return color_name, matching_positions[color_name]
+def get_tile_palette_color(tile_tones, tone_index):
+    tone_positions = [tone_index.get(tone, {}) for tone in tile_tones]
+    tile_colors = get_tile_colors(tile_tones, tone_index)
+    if not tile_colors:
+        raise ConversionError(
+            '[Error] Some tiles use tones that are not in any color of the palette. Analyze the map first.')
+    color_name = tile_colors[0]
+    positions = {tile_tone: positions[color_name]
+                 for tile_tone, positions in zip(tile_tones, tone_positions)}
+    return color_name, positions
 
 
-def load_info(image_path):
+def load_info(image_path, log=None):
     txt_path = image_path.replace('.png', '.txt')
     if not os.path.exists(txt_path):
         return None
@@ -253,13 +450,13 @@ def load_info(image_path):
         if line == '[PALETTE]':
             in_palette_section = True
             in_collision_section = False
-            print('Custom palette found!')
+            print('Custom palette found!', file=log)
             continue
         elif line == '[COLLISIONS]':
             in_palette_section = False
             in_collision_section = True
             if os.path.exists(image_path.replace('.png', '_coll.png')):
-                print('Collision info and mask found!')
+                print('Collision info and mask found!', file=log)
             continue
 
         if in_palette_section:
@@ -286,19 +483,6 @@ def load_info(image_path):
 # ANALYZE ---------------------------------------------------------------------
 
 
-def get_palette_color(tile, palette_colors):
-    '''Used when you don't know the name of the color'''
-    def fits_color(tile, color):
-        unique_tones = {tile.getpixel((x, y))
-                        for x in range(8) for y in range(8)}
-        return len(unique_tones) <= 4 and all(tone in color for tone in unique_tones)
-
-    for index, color in enumerate(palette_colors):
-        if fits_color(tile, color):
-            return index, color
-    return None, None
-
-
 def generate_distinct_colors(n):
     colors = []
     for i in range(n):
@@ -310,253 +494,589 @@ def generate_distinct_colors(n):
     return colors
 
 
-def analyze(image_path):
-    image = Image.open(image_path)
+@profiled
+def analyze(image_path, log=None, output_path=None):
+    '''Check the palette of a map and write the analysis image (a path or a file object,
+    next to the map by default).'''
+    image = Image.open(image_path).convert("RGB")
     width, height = image.size
 
     if width % 32 != 0 or height % 32 != 0:
         raise ValueError("Image dimensions must be multiples of 32")
 
-    tiles = []
-    for y in range(0, height, 8):
-        for x in range(0, width, 8):
-            tile = image.crop((x, y, x + 8, y + 8))
-            tiles.append((x, y, tile))
-
-    tile_color_tones = []
-    wrong_tiles = 0
-    for _, _, tile in tiles:
-        tile_tones = get_tile_tones(tile)
-        if len(tile_tones) <= 4:
-            tile_color_tones.append(tile_tones)
-        else:
-            wrong_tiles += 1
+    # Every tile as a row of 64 colors packed into integers
+    pixels = np.asarray(image)
+    colors = (pixels[..., 0].astype(np.uint32) << 16) | (
+        pixels[..., 1].astype(np.uint32) << 8) | pixels[..., 2]
+    tiles = colors.reshape(height // 8, 8, width // 8, 8).swapaxes(1, 2)
+    tiles = tiles.reshape(-1, 64)
+
+    tones = np.sort(tiles, axis=1)
+    is_new_tone = np.ones(tones.shape, dtype=bool)
+    is_new_tone[:, 1:] = tones[:, 1:] != tones[:, :-1]
+    tone_counts = is_new_tone.sum(axis=1)
+    valid_tiles = tone_counts <= 4
+    wrong_tiles = int(np.count_nonzero(~valid_tiles))
+
+    # Tones of every tile, padded with a value that isn't a color
+    no_tone = 1 << 24
+    tone_sets = np.full(tones.shape, no_tone, dtype=np.uint32)
+    rows, cols = np.nonzero(is_new_tone)
+    tone_positions = np.cumsum(is_new_tone, axis=1) - 1
+    tone_sets[rows, tone_positions[rows, cols]] = tones[rows, cols]
+    tone_sets = np.ascontiguousarray(tone_sets[valid_tiles, :4])
+
+    first, set_indexes = unique_blocks(tone_sets)
+    tile_color_tones = [
+        sort_color((tone >> 16, (tone >> 8) & 0xFF, tone & 0xFF)
+                   for tone in tone_set if tone != no_tone)
+        for tone_set in tone_sets[first].tolist()
+    ]
     palette_colors = process_partial_colors(tile_color_tones)
 
     print("Colors found:", len(palette_colors),
-          "(> 7)" if len(palette_colors) > 7 else "")
-    print("Tiles with more than 4 tones:", wrong_tiles)
+          "(> 7)" if len(palette_colors) > 7 else "", file=log)
+    print("Tiles with more than 4 tones:", wrong_tiles, file=log)
     if len(palette_colors) <= 7 and wrong_tiles == 0:
-        print("The palette is valid!")
+        print("The palette is valid!", file=log)
     else:
-        print("The palette is invalid! The output image will help you fix the errors.")
-
-    mode = "fill"
-    output_image = Image.new("RGB", (width, height))
-    draw = ImageDraw.Draw(output_image)
-    display_colors = generate_distinct_colors(len(palette_colors))
-
-    for x, y, tile in tiles:
-        color_index, color = get_palette_color(tile, palette_colors)
-        if (color_index, color) != (None, None):
-            sorted_color = sort_color(color)
-            for i, tone in enumerate(sorted_color):
-                for dx in range(4):
-                    for dy in range(4):
-                        tile.putpixel((4*(i % 2) + dx, 4*(i//2) + dy), tone)
-            if len(sorted_color) < 4:
-                missing_index = len(sorted_color)
-                for dx in range(4):
-                    for dy in range(4):
-                        tile.putpixel((4*(missing_index % 2) + dx,
-                                       4*(missing_index//2) + dy), (0, 255, 0))
-        output_image.paste(tile, (x, y))
-        if (color_index, color) != (None, None):
-            if mode == "fill":
-                draw.rectangle([x, y, x + 8, y + 8],
-                               fill=display_colors[color_index])
-            else:
-                center_x = x + 3
-                center_y = y + 3
-                draw.rectangle([center_x, center_y, center_x + 1,
-                               center_y + 1], fill=display_colors[color_index])
-        draw.rectangle([x, y, x + 7, y + 7], outline=(0, 0, 0))
-
-    output_image.save(image_path.replace(".png", "_analysis.png"))
+        print("The palette is invalid! The output image will help you fix the errors.", file=log)
+
+    # First color containing the tones of each tile (-1 if none)
+    set_color_indexes = np.array([
+        next((index for index, color in enumerate(palette_colors)
+              if set(tile_tones) <= set(color)), -1)
+        for tile_tones in tile_color_tones
+    ], dtype=np.int64)
+    color_indexes = np.full(len(tiles), -1, dtype=np.int64)
+    color_indexes[valid_tiles] = set_color_indexes[set_indexes]
+    color_indexes = color_indexes.reshape(height // 8, width // 8)
+
+    # Tiles with a color are filled with its display color, the rest keep their pixels
+    output_pixels = pixels.copy()
+    output_tiles = split_into_blocks(output_pixels, 8)
+    display_colors = np.array(generate_distinct_colors(
+        len(palette_colors)), dtype=np.uint8).reshape(-1, 3)
+    matched = color_indexes >= 0
+    output_tiles[matched] = display_colors[color_indexes[matched]][:, None, None]
+
+    # Outline of every tile
+    output_pixels[::8] = 0
+    output_pixels[7::8] = 0
+    output_pixels[:, ::8] = 0
+    output_pixels[:, 7::8] = 0
+
+    if output_path is None:
+        output_path = image_path.replace(".png", "_analysis.png")
+    Image.fromarray(output_pixels).save(output_path, "PNG")
 
 
 # PROCESS ---------------------------------------------------------------------
 
 
-def divide_into_metatiles(image):
-    width, height = image.size
-    metatiles = []
+class ConversionError(Exception):
+    '''Map or options that can't be converted (the message starts with [Error]).'''
+
+
+def split_into_blocks(pixels, size):
+    '''Zero-copy (rows, cols, size, size, 3) view of an image array.'''
+    height, width = pixels.shape[:2]
+    blocks = pixels.reshape(height // size, size, width // size, size, 3)
+    return blocks.swapaxes(1, 2)
+
+
+def unique_blocks(blocks):
+    '''Deduplicate blocks keeping the order of first appearance.
+
+    Returns the position of the first occurrence of every unique block and,
+    for each block, the index of its unique block.
+    '''
+    count = len(blocks)
+    # Pack every block into a row of 64-bit words to speed up the comparisons
+    rows = np.ascontiguousarray(blocks).reshape(count, -1).view(np.uint64)
+    _, first, inverse = np.unique(
+        rows, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return first[order], ranks[inverse.reshape(-1)]
+
+
+@profiled
+def load_map_image(map_path):
+    '''Path or PIL image of the map, returning it as RGB with its darkest tone.'''
+    if not isinstance(map_path, Image.Image):
+        map_path = Image.open(map_path)
+    map_image = map_path.convert("RGB")  # Remove transparency
+    width, height = map_image.size
+    map_tones = [tone for _, tone in map_image.getcolors(width * height)]
+    darkest_tone = sort_color(map_tones)[-1]
+
+    # ? Partial metatiles at the right and bottom edges are padded with black
+    padded_size = (-(-width // 32) * 32, -(-height // 32) * 32)
+    if padded_size != map_image.size:
+        padded_image = Image.new('RGB', padded_size)
+        padded_image.paste(map_image)
+        map_image = padded_image
+    return map_image, darkest_tone
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack(
+        '>I', zlib.crc32(chunk_type + data))
+
+
+def read_png_bands(map_path, band_height=32):
+    '''Yield the image as RGB arrays of band_height rows, decoding one band at a time.
+
+    Every band is wrapped into a small PNG so PIL undoes the filters; its
+    first row is the last one of the previous band, which the filters refer to.
+    Only 8-bit non-interlaced PNGs are streamed, any other image is fully
+    loaded and then split into bands.
+    '''
+    signature = b'\x89PNG\r\n\x1a\n'
+    # Bytes per pixel of every color type
+    color_type_bpp = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    with open(map_path, 'rb') as f:
+        if f.read(8) != signature:
+            raise ConversionError(f'[Error] {map_path} is not a PNG image.')
+        length, _ = struct.unpack('>I4s', f.read(8))
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+            '>IIBBBBB', f.read(length))
+        f.read(4)  # CRC
+
+        if height % band_height != 0:
+            raise ConversionError(
+                f'[Error] Map height must be a multiple of {band_height}.')
+
+        if bit_depth != 8 or interlace or color_type not in color_type_bpp:
+            pixels = np.asarray(Image.open(map_path).convert('RGB'))
+            for y in range(0, height, band_height):
+                yield pixels[y:y + band_height]
+            return
+
+        bpp = color_type_bpp[color_type]
+        stride = width * bpp
+        band_size = band_height * (stride + 1)  # Every row starts with its filter type
+        band_header = png_chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', width, band_height + 1, 8, color_type, 0, 0, 0))
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        decompressor = zlib.decompressobj()
+        data = bytearray()
+        prior = bytes(stride)
+        row = 0
+
+        while row < height:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ConversionError(f'[Error] {map_path} is truncated.')
+            length, chunk_type = struct.unpack('>I4s', header)
+
+            if chunk_type == b'PLTE':
+                colors = np.frombuffer(f.read(length), dtype=np.uint8)
+                palette[:length // 3] = colors.reshape(-1, 3)
+                f.read(4)
+                continue
+            if chunk_type != b'IDAT':
+                f.seek(length + 4, os.SEEK_CUR)
+                continue
+
+            remaining = length
+            while remaining:
+                pending = f.read(min(remaining, 1 << 16))
+                remaining -= len(pending)
+                while pending:
+                    data += decompressor.decompress(pending, band_size)
+                    pending = decompressor.unconsumed_tail
+
+                    while len(data) >= band_size and row < height:
+                        band_data = b'\x00' + prior + data[:band_size]
+                        del data[:band_size]
+                        band_png = signature + band_header + png_chunk(
+                            b'IDAT', zlib.compress(band_data, 0)) + png_chunk(b'IEND', b'')
+                        band = np.asarray(Image.open(io.BytesIO(band_png)))
+                        band = band.reshape(band_height + 1, width, bpp)[1:]
+                        prior = band[-1].tobytes()
+                        row += band_height
+
+                        if color_type == 3:
+                            yield palette[band[..., 0]]
+                        elif bpp >= 3:  # Alpha is removed
+                            yield band[..., :3]
+                        else:  # Grayscale, with or without alpha
+                            yield np.repeat(band[..., :1], 3, axis=2)
+            f.read(4)
+
+
+@profiled
+def stream_unique_metatiles(map_path, log=None):
+    '''Same as identify_unique_metatiles but reading the map one band of metatiles at a time.
+
+    Only the unique metatiles are kept in memory.
+    '''
+    registry = {}  # Metatile bytes -> index (order of first appearance)
     positions = []
-    for y in range(0, height, 32):
-        for x in range(0, width, 32):
-            metatile = image.crop((x, y, x + 32, y + 32))
-            metatiles.append(metatile)
-            positions.append((x // 32 + 1, y // 32 + 1))
+    metatile_indexes = []
+    darkest_tone = None
+    scanned = 0
+
+    for y, band in enumerate(read_png_bands(map_path, 32)):
+        colors = (band[..., 0].astype(np.uint32) << 16) | (
+            band[..., 1].astype(np.uint32) << 8) | band[..., 2]
+        band_tones = [(tone >> 16, (tone >> 8) & 0xFF, tone & 0xFF)
+                      for tone in np.unique(colors).tolist()]
+        darkest_tone = sort_color(
+            band_tones + ([darkest_tone] if darkest_tone else []))[-1]
+
+        if band.shape[1] % 32 != 0:
+            raise ConversionError('[Error] Map width must be a multiple of 32.')
+        blocks = split_into_blocks(band, 32)[0]
+        first, indexes = unique_blocks(blocks)
+        band_metatile_indexes = []
+        for x in first.tolist():
+            key = blocks[x].tobytes()
+            if key not in registry:
+                registry[key] = len(registry)
+                positions.append((x + 1, y + 1))
+            band_metatile_indexes.append(registry[key])
+        metatile_indexes += np.array(band_metatile_indexes)[indexes].tolist()
+        scanned += len(blocks)
+
+    # ? The border metatile comes first, even if it also appears in the map
+    keys = list(registry)
+    border_key = np.full((32, 32, 3), darkest_tone, dtype=np.uint8).tobytes()
+    border_index = registry.get(border_key, len(keys))
+    if border_index < len(keys):
+        del keys[border_index]
+        del positions[border_index]
+    metatile_indexes = [0 if i == border_index else i + 1 if i < border_index else i
+                        for i in metatile_indexes]
+
+    unique_metatiles = np.frombuffer(
+        b''.join([border_key] + keys), dtype=np.uint8).reshape(-1, 32, 32, 3)
+    metatile_positions = [(0, 0)] + positions
+    count('metatiles scanned', scanned)
+    count('unique metatiles', len(unique_metatiles))
+    print('Unique metatiles:', len(unique_metatiles), file=log)
+    return unique_metatiles, metatile_positions, metatile_indexes
+
+
+@profiled
+def divide_into_metatiles(image):
+    pixels = np.asarray(image)
+    metatiles = split_into_blocks(pixels, 32)
+    rows, cols = metatiles.shape[:2]
+    positions = [(x + 1, y + 1) for y in range(rows) for x in range(cols)]
     return metatiles, positions
 
 
-def identify_unique_metatiles(metatiles, positions, darkest_tone):
-    unique_metatiles = []
-    metatile_positions = []
-    metatile_indexes = []
+@profiled
+def identify_unique_metatiles(metatiles, positions, darkest_tone, log=None):
+    border_metatile = np.full((1, 32, 32, 3), darkest_tone, dtype=np.uint8)
+    metatiles = np.concatenate(
+        (border_metatile, metatiles.reshape(-1, 32, 32, 3)))
 
-    border_metatile = Image.new('RGB', (32, 32), color=darkest_tone)
-    unique_metatiles.append(border_metatile)
-    metatile_positions.append((0, 0))
+    first, indexes = unique_blocks(metatiles)
+    unique_metatiles = metatiles[first]
+    count('metatiles scanned', len(metatiles) - 1)
+    count('unique metatiles', len(unique_metatiles))
+    metatile_positions = [(0, 0)] + [positions[i - 1] for i in first[1:]]
+    metatile_indexes = indexes[1:].tolist()
+    print('Unique metatiles:', len(unique_metatiles), file=log)
+    return unique_metatiles, metatile_positions, metatile_indexes
 
-    for i, metatile in enumerate(metatiles):
-        if metatile not in unique_metatiles:
-            unique_metatiles.append(metatile)
-            metatile_positions.append(positions[i])
-        metatile_indexes.append(unique_metatiles.index(metatile))
-    print('Unique metatiles:', len(unique_metatiles))
+
+def get_cell_hashes(cells):
+    '''16-byte hash of every metatile cell of a map.'''
+    return np.frombuffer(b''.join(
+        hashlib.blake2b(cell.tobytes(), digest_size=16).digest() for cell in cells
+    ), dtype=np.uint8).reshape(-1, 16)
+
+
+def relabel_metatiles(cells, changed, positions, unique_metatiles, metatile_indexes, log=None):
+    '''Unique metatiles, their positions and the index of every cell after some cells
+    changed, looking up only those in the previous unique metatiles.'''
+    registry = {metatile.tobytes(): i for i, metatile in enumerate(unique_metatiles)}
+    new_metatiles = []
+    indexes = np.array([0] + list(metatile_indexes))  # The border metatile comes first
+    for cell in changed.tolist():
+        key = cells[cell].tobytes()
+        if key not in registry:
+            registry[key] = len(unique_metatiles) + len(new_metatiles)
+            new_metatiles.append(cells[cell])
+        indexes[cell + 1] = registry[key]
+
+    # ? Renumbered in order of first appearance (unused metatiles are dropped), as a full conversion does
+    first, ranks = unique_blocks(indexes)
+    if new_metatiles:
+        unique_metatiles = np.concatenate((unique_metatiles, np.stack(new_metatiles)))
+    unique_metatiles = unique_metatiles[indexes[first]]
+    metatile_positions = [(0, 0)] + [positions[i - 1] for i in first[1:].tolist()]
+    count('metatiles scanned', len(changed))
+    count('unique metatiles', len(unique_metatiles))
+    print('Unique metatiles:', len(unique_metatiles), file=log)
+    return unique_metatiles, metatile_positions, ranks[1:].tolist()
+
+
+@profiled
+def update_unique_metatiles(map_path, metatiles, positions, darkest_tone, log=None):
+    '''Same as identify_unique_metatiles but only comparing the metatiles
+    that changed since the last conversion of the map (see warm_cache).'''
+    cells = metatiles.reshape(-1, 32, 32, 3)
+    cell_hashes = get_cell_hashes(cells)
+    previous = get_warm('maps', map_path)
+    if previous is None or previous[0] != metatiles.shape[:2] or previous[2] != darkest_tone:
+        result = identify_unique_metatiles(metatiles, positions, darkest_tone, log)
+    else:
+        _, previous_hashes, _, unique_metatiles, metatile_indexes = previous
+        changed = np.flatnonzero((cell_hashes != previous_hashes).any(axis=1))
+        result = relabel_metatiles(
+            cells, changed, positions, unique_metatiles, metatile_indexes, log)
+
+    set_warm('maps', map_path,
+             (metatiles.shape[:2], cell_hashes, darkest_tone, result[0], result[2]))
+    return result
+
+
+def get_stable_indexes(previous_keys, keys):
+    '''New index of every key, keeping the one it had in previous_keys whenever
+    possible. New keys take the free indexes first (the lowest ones).'''
+    previous_indexes = {key: i for i, key in enumerate(previous_keys)}
+    indexes = [previous_indexes.get(key) for key in keys]
+    taken = {index for index in indexes if index is not None and index < len(keys)}
+    free = (index for index in range(len(keys)) if index not in taken)
+    for i, index in enumerate(indexes):
+        if index is None:
+            indexes[i] = next(free)
+    # ? Then the keys whose index is out of range (the list got shorter)
+    for i, index in enumerate(indexes):
+        if index >= len(keys):
+            indexes[i] = next(free)
+    return indexes
+
+
+@profiled
+def restore_unique_metatiles(metatiles, positions, darkest_tone, state, log=None):
+    '''Same as identify_unique_metatiles but only looking up the metatiles that changed
+    since the conversion saved in state, which keep their indexes when possible.
+
+    The state is updated in place.
+    '''
+    cells = metatiles.reshape(-1, 32, 32, 3)
+    cell_hashes = get_cell_hashes(cells)
+
+    same_border = bool(state) and tuple(state['darkest_tone'].tolist()) == darkest_tone
+    if same_border and state['cell_hashes'].shape == cell_hashes.shape:
+        changed = np.flatnonzero((cell_hashes != state['cell_hashes']).any(axis=1))
+        unique_metatiles, metatile_positions, metatile_indexes = relabel_metatiles(
+            cells, changed, positions, state['unique_metatiles'], state['metatile_indexes'].tolist(), log)
+    else:
+        unique_metatiles, metatile_positions, metatile_indexes = identify_unique_metatiles(
+            metatiles, positions, darkest_tone, log)
+
+    # ? The border metatile keeps index 0 since it's the first one in both
+    if same_border:
+        previous_keys = [metatile.tobytes() for metatile in state['unique_metatiles']]
+        stable_indexes = np.array(get_stable_indexes(
+            previous_keys, [metatile.tobytes() for metatile in unique_metatiles]))
+        stable_metatiles = np.empty_like(unique_metatiles)
+        stable_metatiles[stable_indexes] = unique_metatiles
+        stable_positions = [None] * len(metatile_positions)
+        for index, position in zip(stable_indexes.tolist(), metatile_positions):
+            stable_positions[index] = position
+        unique_metatiles, metatile_positions = stable_metatiles, stable_positions
+        metatile_indexes = stable_indexes[metatile_indexes].tolist()
+
+    state.update(
+        cell_hashes=cell_hashes,
+        darkest_tone=np.array(darkest_tone, dtype=np.uint8),
+        unique_metatiles=unique_metatiles,
+        metatile_indexes=np.array(metatile_indexes))
     return unique_metatiles, metatile_positions, metatile_indexes
 
 
-def identify_unique_tiles(unique_metatiles, metatile_positions, palettes, palette=None):
+def extract_tiles(metatiles):
+    '''Unique tiles of some metatiles, the position of their first occurrence,
+    the index of the unique tile of every tile and the tones of every unique tile.'''
+    # Tiles of every metatile, in reading order
+    tiles = split_into_blocks(metatiles.reshape(-1, 32, 3), 8)
+    tiles = tiles.reshape(-1, 8, 8, 3)
+
+    first, indexes = unique_blocks(tiles)
+    unique_tiles = tiles[first]
+    unique_tile_tones = [get_tile_tones(tile) for tile in unique_tiles]
+    return unique_tiles, first, indexes, unique_tile_tones
+
+
+@profiled
+def identify_unique_tiles(unique_metatiles, metatile_positions, palettes, palette=None, workers=None,
+                          tile_registry=None, log=None):
+    '''tile_registry is the list of tiles (bytes) of the last conversion, which keep
+    their indexes when possible. It's updated in place.'''
     monocrhome = False
+    # ? Detected from the tones of the map before the tiles are extracted
+    candidates = find_palette_candidates(unique_metatiles, palettes) if not palette else None
     unique_tiles = []
+    unique_tile_tones = []
+    tiles_first = []
+    metatile_tiles = []
     tile_color_tones = []
-    tile_color_names = []
+    seen_color_tones = set()
     color_to_grays = []
 
-    for i, metatile in enumerate(unique_metatiles):
-        for y in range(0, 32, 8):
-            for x in range(0, 32, 8):
-                tile = metatile.crop((x, y, x + 8, y + 8))
-                if tile not in unique_tiles:
-                    unique_tiles.append(tile)
-                    tile_tones = get_tile_tones(tile)
-                    if len(tile_tones) > 4:
-                        raise SystemExit(
-                            f'[Error] Tile ({x // 8 + 1}, {y // 8 + 1}) in metatile {metatile_positions[i]} has more than 4 colors. Analyze the map first.')
-                    if tile_tones not in tile_color_tones:
-                        tile_color_tones.append(tile_tones)
+    # Consecutive groups of metatiles are processed in parallel
+    shard_count = min(workers or 1, len(unique_metatiles))
+    bounds = np.linspace(0, len(unique_metatiles), shard_count + 1).astype(int).tolist()
+    shards = [unique_metatiles[start:end] for start, end in zip(bounds, bounds[1:])]
+    if shard_count > 1:
+        with ProcessPoolExecutor(max_workers=shard_count) as executor:
+            results = list(executor.map(extract_tiles, shards))
+    else:
+        results = [extract_tiles(shard) for shard in shards]
+
+    # ? Shards are merged in order, so the tiles keep the order of the serial path
+    tile_keys = {}
+    for start, (shard_tiles, shard_first, shard_indexes, shard_tones) in zip(bounds, results):
+        tile_indexes = []
+        for tile, tile_first, tile_tones in zip(shard_tiles, shard_first.tolist(), shard_tones):
+            key = tile.tobytes()
+            if key not in tile_keys:
+                tile_keys[key] = len(unique_tiles)
+                unique_tiles.append(tile)
+                unique_tile_tones.append(tile_tones)
+                tiles_first.append(start * 16 + tile_first)
+            tile_indexes.append(tile_keys[key])
+        metatile_tiles += np.array(tile_indexes)[shard_indexes].reshape(-1, 16).tolist()
+    count('tiles scanned', len(unique_metatiles) * 16)
+    count('unique tiles', len(unique_tiles))
+
+    for tile_tones, tile_first in zip(unique_tile_tones, tiles_first):
+        if len(tile_tones) > 4:
+            i, position = divmod(tile_first, 16)
+            x, y = position % 4, position // 4
+            raise ConversionError(
+                f'[Error] Tile ({x + 1}, {y + 1}) in metatile {metatile_positions[i]} has more than 4 colors. Analyze the map first.')
+        if tuple(tile_tones) not in seen_color_tones:
+            seen_color_tones.add(tuple(tile_tones))
+            tile_color_tones.append(tile_tones)
 
     print(f'Unique tiles: {len(unique_tiles)}',
-          '(> 192)' if len(unique_tiles) > 192 else '')
+          '(> 192)' if len(unique_tiles) > 192 else '', file=log)
 
     palette_colors = process_partial_colors(tile_color_tones)
 
     if palette == 'extract':
         if len(palette_colors) > 7:
-            raise SystemExit(
+            raise ConversionError(
                 f'[Error] {len(palette_colors)} colors found. Limit is 7. Analyze the map first.')
-        print(f'Unique colors: {len(palette_colors)}')
+        print(f'Unique colors: {len(palette_colors)}', file=log)
         return palette_colors, None, None, None
 
     if not palette:
-        print(f'Unique colors: {len(palette_colors)}')
+        print(f'Unique colors: {len(palette_colors)}', file=log)
 
-        palette_name = identify_palette(palette_colors, palettes)
+        palette_name = identify_palette(palette_colors, palettes, candidates, log)
         if palette_name == 'monochrome':
             monocrhome = True
             palette_name = 'morn'
-        palette = palettes[palette_name]
-
-    get_roof_colors(unique_tiles, palette)
-
-    for tile in unique_tiles:
-        tile_tones = get_tile_tones(tile)
-        color, positions = get_tile_palette_color(tile_tones, palette)
-        tile_color_names.append(color)
+        palette = dict(palettes[palette_name])  # ? The roof tones are replaced
+
+    get_roof_colors(unique_tile_tones, palette)
+    tone_index = build_tone_index(palette)
+
+    if tile_registry is not None:
+        registry_keys = [tile.tobytes() for tile in unique_tiles]
+        stable_indexes = get_stable_indexes(tile_registry, registry_keys)
+        order = sorted(range(len(stable_indexes)), key=stable_indexes.__getitem__)
+        unique_tiles = [unique_tiles[i] for i in order]
+        unique_tile_tones = [unique_tile_tones[i] for i in order]
+        metatile_tiles = [[stable_indexes[index] for index in tile_indexes]
+                          for tile_indexes in metatile_tiles]
+        tile_registry[:] = [registry_keys[i] for i in order]
+
+    palette_key = get_palette_key(palette) if warm_cache is not None else None
+    tiles = []
+    for tile, tile_tones in zip(unique_tiles, unique_tile_tones):
+        key = (palette_key, tile.tobytes())
+        entry = get_warm('tiles', key) if warm_cache is not None else None
+        if entry is None:
+            color, positions = get_tile_palette_color(tile_tones, tone_index)
+            entry = (encode_tile(tile, color, positions), positions)
+            if warm_cache is not None:
+                set_warm('tiles', key, entry)
+        else:
+            count('warm tiles')
+        encoded_tile, positions = entry
+        tiles.append(encoded_tile)
         color_to_grays.append(positions)
-        # print(color, positions)
 
     # ? Tile $7F (128) is reserved for the space character
-    if len(unique_tiles) > 192:
-        space_tile = Image.new('RGB', (8, 8), color=(0, 255, 255))
-        unique_tiles.insert(127, space_tile)
-        tile_color_names.insert(127, 'TEXT')
+    if len(tiles) > 192:
+        tiles.insert(127, Tile(bytes(16), 'TEXT'))
         color_to_grays.insert(127, {(0, 255, 255): 0})
 
-    return unique_tiles, tile_color_names, color_to_grays, monocrhome
+        # ? The space tile can't be used in any metatiles
+        metatile_tiles = [[index + 1 if index >= 127 else index for index in tile_indexes]
+                          for tile_indexes in metatile_tiles]
+
+    return tiles, color_to_grays, metatile_tiles, monocrhome
 
 
-def compress_tiles(tiles, tile_color_names, color_to_grays):
+@profiled
+def compress_tiles(tiles, log=None):
     compressed_tiles = []
-    transformations = []
+    compressed_keys = {}  # Canonical 2bpp data -> compressed tile index
+    # Tile index -> (compressed_index, color, flip_x, flip_y)
+    transformations = {}
+
+    # Order in which the flips are tried when a tile matches a compressed tile
+    orientations = ((False, False), (True, False), (False, True), (True, True))
 
     for i, tile in enumerate(tiles):
         # ? Tile $7F (128) is reserved for the space character
         if len(tiles) <= 192 or (len(tiles) > 192 and i != 127):
-            gray_tile = tile_to_grayscale(tile, color_to_grays[i])
-            color = tile_color_names[i]
-            variants = {
-                'original': gray_tile,
-                'flip_x': ImageOps.mirror(gray_tile),
-                'flip_y': ImageOps.flip(gray_tile),
-                'flip_xy': ImageOps.flip(ImageOps.mirror(gray_tile))
-            }
-
-            found = False
-            for variant_name, variant_tile in variants.items():
-                for j, comp_tile in enumerate(compressed_tiles):
-                    if variant_tile.tobytes() == comp_tile.tobytes():
-                        flip_x = 'flip_x' in variant_name or 'flip_xy' in variant_name
-                        flip_y = 'flip_y' in variant_name or 'flip_xy' in variant_name
-                        transformations.append((j, flip_x, flip_y, color))
-
-                        # Reapply transformations to original tile
-                        retransformed_tile = reapply_transformations(
-                            comp_tile, flip_x, flip_y, color_to_grays[i])
-
-                        # Debugging
-                        # tile.save(f"debug/{i}_original_tile.png")
-                        # gray_tile.save(f"debug/{i}_gray_tile.png")
-                        # retransformed_tile.save(f"debug/{i}_retransformed_tile_{variant_name}.png")
-
-                        assert retransformed_tile.tobytes() == tile.tobytes(), \
-                            f"Transformation error: tile {i}, variant {variant_name}, flip_x={flip_x}, flip_y={flip_y}, color={color}"
-
-                        found = True
-                        break
-                if found:
-                    break
-
-            if not found:
-                compressed_tiles.append(gray_tile)
-                transformations.append(
-                    (len(compressed_tiles) - 1, False, False, color))
+            variants = [flip_tile(tile, flip_x, flip_y).data
+                        for flip_x, flip_y in orientations]
+            # All the flips of a tile share the same canonical form
+            key = min(variants)
+
+            j = compressed_keys.get(key)
+            count('compare operations')
+            if j is None:
+                compressed_keys[key] = len(compressed_tiles)
+                compressed_tiles.append(tile)
+                transformations[i] = (
+                    len(compressed_tiles) - 1, tile.color, False, False)
+            else:
+                comp_data = compressed_tiles[j].data
+                flip_x, flip_y = next(orientation for orientation, variant in zip(
+                    orientations, variants) if variant == comp_data)
+                count('compare operations', orientations.index((flip_x, flip_y)) + 1)
+                transformations[i] = (j, tile.color, flip_x, flip_y)
 
     # ? It seems Polished crystal always uses tile $7F for the space character
     if len(compressed_tiles) > 127:
-        space_tile = Image.new('RGB', (8, 8), color=(0, 255, 255))
-        compressed_tiles.insert(127, space_tile)
+        compressed_tiles.insert(127, Tile(bytes(16), 'TEXT'))
 
         # Adjust indices in transformations
-        for idx, (j, flip_x, flip_y, color) in enumerate(transformations):
+        for idx, (j, color, flip_x, flip_y) in transformations.items():
             if j >= 127:
-                transformations[idx] = (j + 1, flip_x, flip_y, color)
+                transformations[idx] = (j + 1, color, flip_x, flip_y)
 
     print(
-        f'Compressed tiles: {len(tiles)} to {len(compressed_tiles)} ({len(tiles) - len(compressed_tiles)})')
+        f'Compressed tiles: {len(tiles)} to {len(compressed_tiles)} ({len(tiles) - len(compressed_tiles)})', file=log)
 
     return compressed_tiles, transformations
 
 
-def reapply_transformations(tile, flip_x, flip_y, color_to_grays):
-    if flip_x:
-        tile = ImageOps.mirror(tile)
-    if flip_y:
-        tile = ImageOps.flip(tile)
-    recolored_tile = tile_to_color(tile, color_to_grays)
-    return recolored_tile
-
-
-def get_attr_metatiles(metatiles, compressed_tiles, transformations, color_to_grays):
-    if len(color_to_grays) > 192:
-        del color_to_grays[127]
-
+@profiled
+def get_attr_metatiles(metatile_tiles, transformations):
     attr_metatiles = []
 
-    for metatile in metatiles:
-        metatile_info = []
-        for y in range(0, 32, 8):
-            for x in range(0, 32, 8):
-                tile = metatile.crop((x, y, x + 8, y + 8))
-                for i, (compressed_index, flip_x, flip_y, color) in enumerate(transformations):
-                    retransformed_tile = reapply_transformations(
-                        compressed_tiles[compressed_index], flip_x, flip_y, color_to_grays[i])
-                    if tile.tobytes() == retransformed_tile.tobytes():
-                        metatile_info.append(
-                            (compressed_index, color, flip_x, flip_y))
-                        break
+    for tile_indexes in metatile_tiles:
+        metatile_info = [transformations[tile_index]
+                         for tile_index in tile_indexes]
         attr_metatiles.append(metatile_info)
 
     return attr_metatiles
@@ -565,12 +1085,6 @@ def get_attr_metatiles(metatiles, compressed_tiles, transformations, color_to_gr
 # MERGE -----------------------------------------------------------------------
 
 
-def read_bin_file(file_path):
-    with open(file_path, 'rb') as f:
-        content = f.read()
-        return [list(content[i:i+16]) for i in range(0, len(content), 16)]
-
-
 def process_tileset(image_path):
     tileset_image = Image.open(image_path).convert("RGB")
     width, height = tileset_image.size
@@ -605,108 +1119,157 @@ def process_tileset(image_path):
     return tiles
 
 
-def merge_maps(map_dir, base_tileset_index, metatiles_index_mappings, ablk=False):
-    map_files = os.listdir(map_dir)
-    base_map_file = os.path.join(map_dir, map_files[base_tileset_index])
+def build_merge_manifest(base_dir, ablk=False):
+    '''Scan the directories once and group the files of every map by its base name.'''
+    data_dir, gfx_dir, map_dir = process_directories(base_dir)
+    extension = '.ablk' if ablk else '.blk'
+    entries = {}
+    pal_files = []
+
+    # Base name suffix -> key in the entry of the map
+    file_kinds = {
+        gfx_dir: [('_palette_map.asm', 'palette_map'), ('.png', 'tileset'), ('.pal', 'pal')],
+        data_dir: [('_metatiles.bin', 'metatiles'), ('_attributes.bin', 'attributes'),
+                   ('_collision.asm', 'collision')]
+    }
+    for dir_path, kinds in file_kinds.items():
+        with os.scandir(dir_path) as files:
+            for file in files:
+                # ? Skip the files of previous merges
+                if not file.is_file() or file.name.startswith('merged'):
+                    continue
+                for suffix, kind in kinds:
+                    if file.name.endswith(suffix):
+                        base_name = file.name[:-len(suffix)]
+                        entries.setdefault(base_name, {'name': base_name})[kind] = file.path
+                        break
+
+    map_paths = {}
+    with os.scandir(map_dir) as files:
+        for file in files:
+            map_name, map_extension = os.path.splitext(file.name)
+            if file.is_file() and map_extension == extension and not map_name.endswith('Merged'):
+                map_paths[map_name] = file.path
+
+    maps = []
+    for base_name in sorted(entries):
+        entry = entries[base_name]
+        if 'pal' in entry:
+            pal_files.append(entry['pal'])
+        map_name = ''.join([word.capitalize() for word in base_name.split('_')])
+        if map_name not in map_paths:
+            continue
+        entry['map'] = map_paths[map_name]
 
-    base_map = read_bin_file(base_map_file)
-    base_map_count = len(base_map)
+        required = ['tileset', 'metatiles', 'collision'] + (['attributes'] if ablk else [])
+        missing = [kind for kind in required if kind not in entry]
+        if missing:
+            raise SystemExit(
+                f'[Error] Missing {", ".join(missing)} file(s) of {base_name}.')
+        maps.append(entry)
+
+    if len(maps) < 2:
+        raise SystemExit(f'[Error] At least 2 maps ({extension}) are needed to merge.')
+
+    return {
+        'data_dir': data_dir,
+        'gfx_dir': gfx_dir,
+        'map_dir': map_dir,
+        'pal_files': pal_files,
+        'maps': maps
+    }
 
-    for map_file in map_files:
-        if map_file != os.path.basename(base_map_file):
-            file_path = os.path.join(map_dir, map_file)
-            map = read_bin_file(file_path)
 
-            new_map = []
-            for line in map:
-                line_length = len(line)
-                for i in range(line_length):
-                    mapped = False
-                    for mapping in metatiles_index_mappings:
-                        if line[i] in mapping:
-                            line[i] = mapping[line[i]]
-                            mapped = True
-                            break
-                    if not mapped:
-                        new_metatile_index = base_map_count + len(base_map)
-                        line[i] = new_metatile_index
+@profiled
+def merge_maps(manifest, base_tileset_index, metatiles_index_mappings, ablk=False):
+    '''Rewrite the maps with the merged metatile indexes (the base map doesn't change).'''
+    for i, entry in enumerate(manifest['maps']):
+        if i == base_tileset_index:
+            continue
 
-                new_map.append(line)
+        # Flat lookup table: metatile index in the map -> merged metatile index
+        lookup_table = metatiles_index_mappings[i]
+        if max(lookup_table) > 255:
+            raise SystemExit(
+                f'[Error] {os.path.basename(entry["map"])} uses merged metatiles over $FF.')
+        map_data = read_bin_file(entry['map'])
+        if len(map_data) and map_data.max() >= len(lookup_table):
+            raise SystemExit(
+                f'[Error] {os.path.basename(entry["map"])} uses metatiles missing from its tileset.')
+        new_map = map_data.tobytes().translate(translation_table(lookup_table))
 
-            extension = 'ablk' if ablk else 'blk'
+        extension = 'ablk' if ablk else 'blk'
 
-            output_file_path = os.path.join(
-                map_dir, f"{os.path.splitext(map_file)[0]}Merged.{extension}")
-            with open(output_file_path, 'wb') as f:
-                for metatile in new_map:
-                    f.write(bytes(metatile))
+        map_name = os.path.splitext(os.path.basename(entry['map']))[0]
+        output_file_path = os.path.join(
+            manifest['map_dir'], f"{map_name}Merged.{extension}")
+        write_bin_file(output_file_path, new_map)
 
 
 # blk -------------------------------------------------------------------------
 
 
-def merge_blk_tilesets(gfx_dir):
+@profiled
+def merge_blk_tilesets(manifest):
+    gfx_dir = manifest['gfx_dir']
     tilesets = []
     palette_maps = []
-    found_pal_file = False
-    for filename in os.listdir(gfx_dir):
-        if filename.endswith('.png'):
-            tileset_path = os.path.join(gfx_dir, filename)
-            tiles = process_tileset(tileset_path)
-            tilesets.append(tiles)
-        elif filename.endswith('.asm'):
-            palette_map_path = os.path.join(gfx_dir, filename)
-            palette_map = []
-            with open(palette_map_path, 'r') as f:
+    for entry in manifest['maps']:
+        tiles = process_tileset(entry['tileset'])
+        tilesets.append(tiles)
+
+        # ? Monochrome maps don't have a palette map
+        palette_map = []
+        if 'palette_map' in entry:
+            with open(entry['palette_map'], 'r') as f:
                 lines = f.read().strip().split('\n')
                 for line in lines:
                     if line.startswith('\ttilepal'):
                         colors = line.split(', ')[1:]
                         palette_map.extend(colors)
-            palette_maps.append(palette_map)
-        elif filename.endswith('.pal') and not found_pal_file:
-            pal_file_path = os.path.join(gfx_dir, filename)
-            shutil.copy(pal_file_path, os.path.join(gfx_dir, 'merged.pal'))
-            found_pal_file = True
-
-    base_tileset = max(tilesets, key=len)
-    base_tileset_index = tilesets.index(base_tileset)
-    base_palette_map = palette_maps[base_tileset_index]
-
-    tiles_index_mappings = [{} for _ in range(len(tilesets))]
-
-    for i, tileset in enumerate(tilesets):
-        if i == base_tileset_index:
-            continue
-
-        for tile_index, tile in enumerate(tileset):
-            for base_tile_index, base_tile in enumerate(base_tileset):
-                if tile.tobytes() == base_tile.tobytes():
-                    if palette_maps[i][tile_index] == base_palette_map[base_tile_index]:
-                        tiles_index_mappings[i][tile_index] = base_tile_index
+        else:
+            palette_map = [None] * len(tiles)
+        palette_maps.append(palette_map)
+
+    if manifest['pal_files']:
+        shutil.copy(manifest['pal_files'][0], os.path.join(gfx_dir, 'merged.pal'))
+
+    # ? The largest tileset goes first so its indexes (and its map) don't change
+    base_tileset_index = tilesets.index(max(tilesets, key=len))
+    base_tileset = tilesets[base_tileset_index]
+    merge_order = [base_tileset_index] + \
+        [i for i in range(len(tilesets)) if i != base_tileset_index]
+
+    # Every tileset is merged into one registry keyed by (tile bytes, palette color)
+    merged_tiles = []
+    merged_palette_map = []
+    tile_keys = {}
+    # Tileset index -> lookup table (tile index -> merged tile index)
+    tiles_index_mappings = [None] * len(tilesets)
+
+    for i in merge_order:
+        tiles_index_mapping = []
+        for tile_index, tile in enumerate(tilesets[i]):
+            color = palette_maps[i][tile_index]
+            key = (tile.tobytes(), color)
+            if i == base_tileset_index:
+                tile_keys.setdefault(key, len(merged_tiles))
+            elif key in tile_keys:
+                tiles_index_mapping.append(tile_keys[key])
+                continue
+            else:
+                tile_keys[key] = len(merged_tiles)
+            tiles_index_mapping.append(len(merged_tiles))
+            merged_tiles.append(tile)
+            merged_palette_map.append(color)
+        tiles_index_mappings[i] = tiles_index_mapping
 
-                        # debug_dir = os.path.join(gfx_dir, 'debug')
-                        # os.makedirs(debug_dir, exist_ok=True)
-                        # debug_image = Image.new('RGB', (8, 16))
-                        # debug_image.paste(tile, (0, 0))
-                        # debug_image.paste(base_tile, (0, 8))
-                        # debug_image_path = os.path.join(debug_dir, f'match_{i}_{tile_index}_{base_tile_index}.png')
-                        # debug_image.save(debug_image_path)
-
-                        break
+    print(f'Merged tiles: {len(merged_tiles)}',
+          '(> 192)' if len(merged_tiles) > 192 else '')
+    if len(merged_tiles) > 256:
+        raise SystemExit('[Error] Merged tiles don\'t fit in the tile indexes ($00-$FF).')
 
     tile_width, tile_height = base_tileset[0].size
-    merged_tiles = base_tileset[:]
-    merged_palette_map = base_palette_map[:len(base_tileset)]
-    for i, tileset in enumerate(tilesets):
-        if i == base_tileset_index:
-            continue
-        for tile_index, tile in enumerate(tileset):
-            if tile_index not in tiles_index_mappings[i]:
-                tiles_index_mappings[i][tile_index] = len(merged_tiles)
-                merged_tiles.append(tile)
-                merged_palette_map.append(palette_maps[i][tile_index])
-
     merged_width = tile_width * 16
     merged_height = tile_height * ((len(merged_tiles) + 15) // 16)
     merged_image = Image.new(
@@ -720,77 +1283,67 @@ def merge_blk_tilesets(gfx_dir):
     merged_image_path = os.path.join(gfx_dir, 'merged.png')
     merged_image.save(merged_image_path)
 
-    save_palette_map_asm_file(merged_palette_map, os.path.join(
-        gfx_dir, 'merged_palette_map.asm'))
-
-    tiles_index_mappings = [mapping for i, mapping in enumerate(
-        tiles_index_mappings) if i != base_tileset_index]
+    if None not in merged_palette_map:
+        save_palette_map_asm_file(merged_palette_map, os.path.join(
+            gfx_dir, 'merged_palette_map.asm'))
+    elif any(merged_palette_map):
+        raise SystemExit('[Error] Monochrome maps can\'t be merged with colored ones.')
 
     return base_tileset_index, tiles_index_mappings
 
 
-def merge_blk_metatiles(data_dir, base_tileset_index, tiles_index_mappings):
-    bin_files = [f for f in os.listdir(data_dir) if f.endswith('.bin')]
-    base_metatiles_file = os.path.join(data_dir, bin_files[base_tileset_index])
-
-    base_metatiles = read_bin_file(base_metatiles_file)
-    base_metatiles_count = len(base_metatiles)
-
-    collision_files = [f for f in os.listdir(
-        data_dir) if f.endswith('collision.asm')]
-    if len(collision_files) == 0 or len(collision_files) != len(bin_files):
-        raise SystemExit('[Error] Some collision files are missing.')
-
-    base_collision_file = os.path.join(
-        data_dir, collision_files[base_tileset_index])
-    with open(base_collision_file, 'r') as f:
-        base_collision_lines = [
-            line for line in f if line.startswith('\ttilecoll')]
-    new_collision_lines = base_collision_lines[:]
-
-    metatiles_index_mappings = []
-
-    for filename in bin_files:
-        if filename != os.path.basename(base_metatiles_file):
-            file_path = os.path.join(data_dir, filename)
-            metatiles = read_bin_file(file_path)
-
-            collision_file_path = file_path.replace(
-                'metatiles.bin', 'collision.asm')
-            with open(collision_file_path, 'r') as f:
-                collision_lines = [
-                    line for line in f if line.startswith('\ttilecoll')]
-
-            file_index_mapping = {}
-            for metatile_index, metatile in enumerate(metatiles):
-                for i in range(16):
-                    tile_index = metatile[i]
-                    for mapping in tiles_index_mappings:
-                        if tile_index in mapping:
-                            metatile[i] = mapping[tile_index]
-                            break
-                match_found = False
-                for base_metatile_index, base_metatile in enumerate(base_metatiles[:base_metatiles_count]):
-                    if metatile == base_metatile:
-                        file_index_mapping[metatile_index] = base_metatile_index
-                        match_found = True
-                        break
-                if not match_found:
-                    file_index_mapping[metatile_index] = len(base_metatiles)
-                    base_metatiles.append(metatile)
-                    new_collision_lines.append(collision_lines[metatile_index])
+@profiled
+def merge_blk_metatiles(manifest, base_tileset_index, tiles_index_mappings):
+    data_dir = manifest['data_dir']
+    entries = manifest['maps']
+
+    merge_order = [base_tileset_index] + \
+        [i for i in range(len(entries)) if i != base_tileset_index]
+
+    # Every metatile (with the merged tile indexes) goes into one registry
+    merged_metatiles = []
+    merged_collision_lines = []
+    metatile_keys = {}
+    # File index -> lookup table (metatile index -> merged metatile index)
+    metatiles_index_mappings = [None] * len(entries)
+
+    for i in merge_order:
+        metatiles = read_bin_file(entries[i]['metatiles'])
+        with open(entries[i]['collision'], 'r') as f:
+            collision_lines = [
+                line for line in f if line.startswith('\ttilecoll')]
+
+        tiles_index_mapping = tiles_index_mappings[i]
+        if len(metatiles) and metatiles.max() >= len(tiles_index_mapping):
+            raise SystemExit(
+                f'[Error] {entries[i]["name"]}_metatiles.bin uses tiles missing from its tileset.')
+        metatiles = metatiles.tobytes().translate(
+            translation_table(tiles_index_mapping))
+
+        metatiles_index_mapping = []
+        for metatile_index in range(len(metatiles) // 16):
+            metatile = metatiles[metatile_index * 16:(metatile_index + 1) * 16]
+            if i == base_tileset_index:
+                metatile_keys.setdefault(metatile, len(merged_metatiles))
+            elif metatile in metatile_keys:
+                metatiles_index_mapping.append(metatile_keys[metatile])
+                continue
+            else:
+                metatile_keys[metatile] = len(merged_metatiles)
+            metatiles_index_mapping.append(len(merged_metatiles))
+            merged_metatiles.append(metatile)
+            merged_collision_lines.append(collision_lines[metatile_index])
+        metatiles_index_mappings[i] = metatiles_index_mapping
 
-            if file_index_mapping:
-                metatiles_index_mappings.append(file_index_mapping)
+    print(f'Merged metatiles: {len(merged_metatiles)}',
+          '(> 255)' if len(merged_metatiles) > 255 else '')
 
-    output_file_path = os.path.join(data_dir, 'merged_metatiles.bin')
-    with open(output_file_path, 'wb') as f:
-        for metatile in base_metatiles:
-            f.write(bytes(metatile))
+    write_bin_file(os.path.join(data_dir, 'merged_metatiles.bin'),
+                   b''.join(merged_metatiles))
 
     output_file_path = os.path.join(data_dir, 'merged_collision.asm')
     with open(output_file_path, 'w') as f:
-        for line in new_collision_lines:
+        for line in merged_collision_lines:
             f.write(line)
 
     return metatiles_index_mappings
@@ -799,68 +1352,51 @@ def merge_blk_metatiles(data_dir, base_tileset_index, tiles_index_mappings):
 # ablk ------------------------------------------------------------------------
 
 
-def merge_ablk_tilesets(gfx_dir):
-    tilesets = []
-    found_pal_file = False
-    for filename in os.listdir(gfx_dir):
-        if filename.endswith('.png'):
-            tileset_path = os.path.join(gfx_dir, filename)
-            tiles = process_tileset(tileset_path)
-            tilesets.append(tiles)
-        elif filename.endswith('.pal') and not found_pal_file:
-            pal_file_path = os.path.join(gfx_dir, filename)
-            shutil.copy(pal_file_path, os.path.join(gfx_dir, 'merged.pal'))
-            found_pal_file = True
-
-    base_tileset = max(tilesets, key=len)
-    base_tileset_index = tilesets.index(base_tileset)
-
-    tiles_index_mappings = [{} for _ in range(len(tilesets))]
-
-    for i, tileset in enumerate(tilesets):
-        if i == base_tileset_index:
-            continue
-
-        for tile_index, tile in enumerate(tileset):
-            for base_tile_index, base_tile in enumerate(base_tileset):
-                # Compare the original tile
-                if tile.tobytes() == base_tile.tobytes():
-                    tiles_index_mappings[i][tile_index] = (
-                        base_tile_index, False, False)
-                    break
-
-                # Compare the tile with flip x
-                tile_flipped_x = ImageOps.mirror(tile)
-                if tile_flipped_x.tobytes() == base_tile.tobytes():
-                    tiles_index_mappings[i][tile_index] = (
-                        base_tile_index, True, False)
-                    break
-
-                # Comparar the tile with flip y
-                tile_flipped_y = ImageOps.flip(tile)
-                if tile_flipped_y.tobytes() == base_tile.tobytes():
-                    tiles_index_mappings[i][tile_index] = (
-                        base_tile_index, False, True)
-                    break
-
-                # Comparar the tile with flip x and y
-                tile_flipped_xy = ImageOps.mirror(tile_flipped_y)
-                if tile_flipped_xy.tobytes() == base_tile.tobytes():
-                    tiles_index_mappings[i][tile_index] = (
-                        base_tile_index, True, True)
-                    break
+@profiled
+def merge_ablk_tilesets(manifest):
+    gfx_dir = manifest['gfx_dir']
+    tilesets = [process_tileset(entry['tileset']) for entry in manifest['maps']]
+
+    if manifest['pal_files']:
+        shutil.copy(manifest['pal_files'][0], os.path.join(gfx_dir, 'merged.pal'))
+
+    # ? The largest tileset goes first so its indexes (and its map) don't change
+    base_tileset_index = tilesets.index(max(tilesets, key=len))
+    base_tileset = tilesets[base_tileset_index]
+    merge_order = [base_tileset_index] + \
+        [i for i in range(len(tilesets)) if i != base_tileset_index]
+
+    # Every tileset is merged into one registry keyed by the bytes of every orientation
+    # of its tiles -> (first merged tile index, flip_x, flip_y)
+    # ? A tile flipped one way matches a merged tile if the merged tile flipped the same way matches it
+    merged_tiles = []
+    tile_keys = {}
+    # Tileset index -> lookup table (tile index -> (merged tile index, flip_x, flip_y))
+    tiles_index_mappings = [None] * len(tilesets)
+
+    for i in merge_order:
+        tiles_index_mapping = []
+        for tile in tilesets[i]:
+            tile_mapping = tile_keys.get(tile.tobytes())
+            if tile_mapping is not None and i != base_tileset_index:
+                tiles_index_mapping.append(tile_mapping)
+                continue
+
+            pixels = np.asarray(tile)
+            for flip_x, flip_y in ((False, False), (True, False), (False, True), (True, True)):
+                variant = pixels[::-1 if flip_y else 1, ::-1 if flip_x else 1]
+                tile_keys.setdefault(
+                    variant.tobytes(), (len(merged_tiles), flip_x, flip_y))
+            tiles_index_mapping.append((len(merged_tiles), False, False))
+            merged_tiles.append(tile)
+        tiles_index_mappings[i] = tiles_index_mapping
+
+    print(f'Merged tiles: {len(merged_tiles)}',
+          '(> 192)' if len(merged_tiles) > 192 else '')
+    if len(merged_tiles) > 256:
+        raise SystemExit('[Error] Merged tiles don\'t fit in the tile indexes ($00-$FF).')
 
     tile_width, tile_height = base_tileset[0].size
-    merged_tiles = base_tileset[:]
-    for i, tileset in enumerate(tilesets):
-        if i == base_tileset_index:
-            continue
-        for tile_index, tile in enumerate(tileset):
-            if tile_index not in tiles_index_mappings[i]:
-                tiles_index_mappings[i][tile_index] = (
-                    len(merged_tiles), False, False)
-                merged_tiles.append(tile)
-
     merged_width = tile_width * 16
     merged_height = tile_height * ((len(merged_tiles) + 15) // 16)
     merged_image = Image.new(
@@ -874,126 +1410,78 @@ def merge_ablk_tilesets(gfx_dir):
     merged_image_path = os.path.join(gfx_dir, 'merged.png')
     merged_image.save(merged_image_path)
 
-    tiles_index_mappings = [mapping for i, mapping in enumerate(
-        tiles_index_mappings) if i != base_tileset_index]
-
     return base_tileset_index, tiles_index_mappings
 
 
-def merge_ablk_metatiles(data_dir, base_tileset_index, tiles_index_mappings):
-    def get_tile_index_real(tile_index, tile_info):
-        tile_bank = (tile_info >> 3) & 1
-        if tile_bank == 1:
-            tile_index += 128  # $80 = 128
-        return tile_index
-
-    def set_tile(tile_index_mapping, tile_attrs):
-        tile_index_real, flip_x, flip_y = tile_index_mapping
-        if tile_index_real >= 128:
-            tile_bank = 1
-            tile_index = tile_index_real - 128
-        else:
-            tile_bank = 0
-            tile_index = tile_index_real
-
-        if tile_bank == 1:
-            tile_attrs |= (1 << 3)
-        else:
-            tile_attrs &= ~(1 << 3)
-
+@profiled
+def merge_ablk_metatiles(manifest, base_tileset_index, tiles_index_mappings):
+    data_dir = manifest['data_dir']
+    entries = manifest['maps']
+
+    merge_order = [base_tileset_index] + \
+        [i for i in range(len(entries)) if i != base_tileset_index]
+
+    # Every metatile (with the merged tile indexes and attributes) goes into one registry
+    merged_metatiles = []
+    merged_attributes = []
+    merged_collision_lines = []
+    metatile_keys = {}
+    # File index -> lookup table (metatile index -> merged metatile index)
+    metatiles_index_mappings = [None] * len(entries)
+
+    for i in merge_order:
+        metatiles = read_bin_file(entries[i]['metatiles'])
+        attributes = read_bin_file(entries[i]['attributes'])
+        with open(entries[i]['collision'], 'r') as f:
+            collision_lines = [
+                line for line in f if line.startswith('\ttilecoll')]
+
+        # Tile indexes use bit 3 of the attributes as the VRAM bank
+        tile_indexes = metatiles.astype(np.int64) + ((attributes >> 3) & 1) * 0x80
+        if len(tile_indexes) and tile_indexes.max() >= len(tiles_index_mappings[i]):
+            raise SystemExit(
+                f'[Error] {entries[i]["name"]}_metatiles.bin uses tiles missing from its tileset.')
+
+        # Merged tile index, flip_x and flip_y of every tile
+        tile_mappings = np.array(tiles_index_mappings[i], dtype=np.int64)[tile_indexes]
+        merged_indexes = tile_mappings[:, 0]
+        banks = merged_indexes >= 0x80
+        metatiles = (merged_indexes % 0x80).astype(np.uint8).tobytes()
+        attributes = (attributes & 0xF7) | (banks << 3)
         # Invert bits 5 and 6
-        if flip_x:
-            tile_attrs ^= (1 << 5)
-        if flip_y:
-            tile_attrs ^= (1 << 6)
-
-        return tile_index, tile_attrs
-
-    metatiles_files = [f for f in os.listdir(
-        data_dir) if f.endswith('metatiles.bin')]
-    base_metatiles_file = os.path.join(
-        data_dir, metatiles_files[base_tileset_index])
-
-    base_metatiles = read_bin_file(base_metatiles_file)
-    base_metatiles_count = len(base_metatiles)
-
-    attributes_files = [f for f in os.listdir(
-        data_dir) if f.endswith('attributes.bin')]
-    base_attributes_file = os.path.join(
-        data_dir, attributes_files[base_tileset_index])
-
-    base_attributes = read_bin_file(base_attributes_file)
-
-    collision_files = [f for f in os.listdir(
-        data_dir) if f.endswith('collision.asm')]
-    if len(collision_files) == 0 or len(collision_files) != len(metatiles_files):
-        raise SystemExit('[Error] Some collision files are missing.')
-
-    base_collision_file = os.path.join(
-        data_dir, collision_files[base_tileset_index])
-    with open(base_collision_file, 'r') as f:
-        base_collision_lines = [
-            line for line in f if line.startswith('\ttilecoll')]
-    new_collision_lines = base_collision_lines[:]
-
-    metatiles_index_mappings = []
-
-    for filename in metatiles_files:
-        if filename != os.path.basename(base_metatiles_file):
-            file_path = os.path.join(data_dir, filename)
-            metatiles = read_bin_file(file_path)
-            attributes = read_bin_file(file_path.replace(
-                'metatiles.bin', 'attributes.bin'))
-
-            collision_file_path = file_path.replace(
-                'metatiles.bin', 'collision.asm')
-            with open(collision_file_path, 'r') as f:
-                collision_lines = [
-                    line for line in f if line.startswith('\ttilecoll')]
-
-            file_index_mapping = {}
-            for metatile_index, metatile in enumerate(metatiles):
-                metatile_attrs = attributes[metatile_index]
-                for i in range(16):
-                    tile_index = metatile[i]
-                    tile_attrs = metatile_attrs[i]
-                    tile_index_real = get_tile_index_real(
-                        tile_index, tile_attrs)
-                    for mapping in tiles_index_mappings:
-                        if tile_index_real in mapping:
-                            tile_info = set_tile(
-                                mapping[tile_index_real], tile_attrs)
-                            metatile[i] = tile_info[0]
-                            metatile_attrs[i] = tile_info[1]
-                            break
-                match_found = False
-                for base_metatile_index, base_metatile in enumerate(base_metatiles[:base_metatiles_count]):
-                    if metatile == base_metatile and metatile_attrs == base_attributes[base_metatile_index]:
-                        file_index_mapping[metatile_index] = base_metatile_index
-                        match_found = True
-                        break
-                if not match_found:
-                    file_index_mapping[metatile_index] = len(base_metatiles)
-                    base_metatiles.append(metatile)
-                    base_attributes.append(metatile_attrs)
-                    new_collision_lines.append(collision_lines[metatile_index])
-
-            if file_index_mapping:
-                metatiles_index_mappings.append(file_index_mapping)
+        attributes ^= (tile_mappings[:, 1] << 5) | (tile_mappings[:, 2] << 6)
+        attributes = attributes.astype(np.uint8).tobytes()
+
+        metatiles_index_mapping = []
+        for metatile_index in range(len(metatiles) // 16):
+            metatile = metatiles[metatile_index * 16:(metatile_index + 1) * 16]
+            metatile_attrs = attributes[metatile_index * 16:(metatile_index + 1) * 16]
+
+            key = metatile + metatile_attrs
+            if i == base_tileset_index:
+                metatile_keys.setdefault(key, len(merged_metatiles))
+            elif key in metatile_keys:
+                metatiles_index_mapping.append(metatile_keys[key])
+                continue
+            else:
+                metatile_keys[key] = len(merged_metatiles)
+            metatiles_index_mapping.append(len(merged_metatiles))
+            merged_metatiles.append(metatile)
+            merged_attributes.append(metatile_attrs)
+            merged_collision_lines.append(collision_lines[metatile_index])
+        metatiles_index_mappings[i] = metatiles_index_mapping
 
-    output_file_path = os.path.join(data_dir, 'merged_metatiles.bin')
-    with open(output_file_path, 'wb') as f:
-        for metatile in base_metatiles:
-            f.write(bytes(metatile))
+    print(f'Merged metatiles: {len(merged_metatiles)}',
+          '(> 255)' if len(merged_metatiles) > 255 else '')
 
-    output_file_path = os.path.join(data_dir, 'merged_attributes.bin')
-    with open(output_file_path, 'wb') as f:
-        for attrs in base_attributes:
-            f.write(bytes(attrs))
+    write_bin_file(os.path.join(data_dir, 'merged_metatiles.bin'),
+                   b''.join(merged_metatiles))
+    write_bin_file(os.path.join(data_dir, 'merged_attributes.bin'),
+                   b''.join(merged_attributes))
 
     output_file_path = os.path.join(data_dir, 'merged_collision.asm')
     with open(output_file_path, 'w') as f:
-        for line in new_collision_lines:
+        for line in merged_collision_lines:
             f.write(line)
 
     return metatiles_index_mappings
@@ -1013,6 +1501,34 @@ def ensure_file(base_dir, file_name):
                 "# Polished Map++ assumes a directory with a Main.asm is the main project directory.\n")
 
 
+def read_bin_file(file_path):
+    '''Bytes of a binary file as a memory-mapped array.'''
+    with open(file_path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return np.empty(0, dtype=np.uint8)
+        # ? The mapping stays open while the array is in use
+        return np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
+
+def write_bin_file(output_path, data):
+    '''Write bytes (or a sequence of byte values, nested or not) with a single call.'''
+    if not isinstance(data, (bytes, bytearray)):
+        values = np.asarray(data, dtype=np.int64)
+        # ? NumPy 1.x wraps values out of range instead of raising
+        if values.size and (values.min() < 0 or values.max() > 255):
+            raise ConversionError(
+                f'[Error] {os.path.basename(output_path)} needs values above 255 '
+                '(more than 256 metatiles or tiles).')
+        data = values.astype(np.uint8).tobytes()
+    with open(output_path, 'wb') as f:
+        f.write(data)
+
+
+def translation_table(lookup_table):
+    '''256-byte table for bytes.translate from a list of indexes.'''
+    return bytes(lookup_table) + bytes(256 - len(lookup_table))
+
+
 def process_directories(base_dir, create=False):
     directories = [
         "data/tilesets",
@@ -1022,8 +1538,8 @@ def process_directories(base_dir, create=False):
     dir_paths = []
     for directory in directories:
         path = os.path.join(base_dir, directory)
-        if create and not os.path.exists(path):
-            os.makedirs(path)
+        if create:
+            os.makedirs(path, exist_ok=True)
         dir_paths.append(path)
     return dir_paths
 
@@ -1031,12 +1547,12 @@ def process_directories(base_dir, create=False):
 # SAVE ------------------------------------------------------------------------
 
 
+@profiled
 def save_blk_file(output_path, metatile_indexes):
-    with open(output_path, 'wb') as f:
-        for position in metatile_indexes:
-            f.write(position.to_bytes(1, 'big'))
+    write_bin_file(output_path, metatile_indexes)
 
 
+@profiled
 def save_palette_txt_file(image_path, palette):
     with open(f"{image_path[:-4]}.txt", "w") as file:
         file.write("[PALETTE]\n\n")
@@ -1050,6 +1566,7 @@ def save_palette_txt_file(image_path, palette):
                 file.write("\n")
 
 
+@profiled
 def save_pal_file(pal_path, custom_palette, compress):
     color_order = palettes['morn'].keys()
     with open(pal_path, 'w') as file:
@@ -1072,31 +1589,48 @@ def save_pal_file(pal_path, custom_palette, compress):
                     file.write(f"\tRGB {r:02}, {g:02}, {b:02}\n")
 
 
-def save_collision_asm_file(collision_mask, collision_colors, metatile_positions, output_path):
-    metatile_collisions = []
-
-    for i, (pos_x, pos_y) in enumerate(metatile_positions):
-
-        real_x = (pos_x - 1) * 32
-        real_y = (pos_y - 1) * 32
-        collision_metatile = collision_mask.crop(
-            (real_x, real_y, real_x + 32, real_y + 32))
-
-        collisions = []
-        for tile_y in range(0, 32, 16):
-            for tile_x in range(0, 32, 16):
-                color = collision_metatile.getpixel((tile_x, tile_y))
-                if color:
-                    hex_color = '#{:02x}{:02x}{:02x}'.format(*color)
-                    collision_type = collision_colors.get(
-                        hex_color, '?') if i != 0 else 'VOID'
-                    collisions.append(collision_type)
-
-                    # metatiles[i].save(os.path.join('debug', f'metatile_{i}.png'))
-                    # collision_metatile.save(os.path.join('debug', f'collision_metatile_{i}.png'))
-
-        metatile_collisions.append(collisions)
-
+@profiled
+def load_collision_grid(mask_path, stream=False):
+    '''Colors of the collision mask (a path or a PIL image) at every 16 pixels, packed into integers.'''
+    if isinstance(mask_path, Image.Image):
+        grid = np.asarray(mask_path.convert('RGB'))[::16, ::16]
+    elif stream:
+        grid = np.stack([band[0, ::16] for band in read_png_bands(mask_path, 16)])
+    else:
+        grid = np.asarray(Image.open(mask_path).convert('RGB'))[::16, ::16]
+    return (grid[..., 0].astype(np.uint32) << 16) | (
+        grid[..., 1].astype(np.uint32) << 8) | grid[..., 2]
+
+
+@profiled
+def get_metatile_collisions(collision_grid, collision_colors, metatile_positions):
+    # Packed color -> collision name
+    collision_table = {int(hex_color[1:], 16): collision_name
+                       for hex_color, collision_name in collision_colors.items()
+                       if len(hex_color) == 7 and all(c in '0123456789ABCDEFabcdef' for c in hex_color[1:])}
+
+    # Grid points of the 4 collisions of every metatile (top-left, top-right, bottom-left, bottom-right)
+    positions = np.array(metatile_positions, dtype=np.int64).reshape(-1, 2)
+    xs = (positions[:, :1] - 1) * 2 + np.array([0, 1, 0, 1])
+    ys = (positions[:, 1:] - 1) * 2 + np.array([0, 0, 1, 1])
+
+    # ? Points outside the mask (like the ones of the border metatile) are black
+    grid_height, grid_width = collision_grid.shape
+    inside = (xs >= 0) & (ys >= 0) & (xs < grid_width) & (ys < grid_height)
+    colors = np.zeros(xs.shape, dtype=np.uint32)
+    colors[inside] = collision_grid[ys[inside], xs[inside]]
+
+    unique_colors, color_indexes = np.unique(colors, return_inverse=True)
+    collision_names = np.array([collision_table.get(color, '?')
+                                for color in unique_colors.tolist()], dtype=object)
+    metatile_collisions = collision_names[color_indexes.reshape(colors.shape)].tolist()
+    if metatile_collisions:
+        metatile_collisions[0] = ['VOID'] * 4
+    return metatile_collisions
+
+
+@profiled
+def save_collision_asm_file(metatile_collisions, output_path):
     lines = []
     for i, collisions in enumerate(metatile_collisions):
         line = f"\ttilecoll {', '.join(collisions)} ; {i:02x}"
@@ -1110,44 +1644,32 @@ def save_collision_asm_file(collision_mask, collision_colors, metatile_positions
 # blk -------------------------------------------------------------------------
 
 
+@profiled
 def save_tileset_image(tiles, color_to_grays, output_path, grayscale=True):
     num_rows = (len(tiles) + 15) // 16
     height = num_rows * 8
 
-    tileset_image = Image.new('RGB', (128, height), (255, 255, 255))
-
-    if grayscale:
-        for i, tile in enumerate(tiles):
-            new_tile = tile if len(tiles) > 192 and i == 127 else tile_to_grayscale(
-                tile, color_to_grays[i])
-            x = (i % 16) * 8
-            y = (i // 16) * 8
-            tileset_image.paste(new_tile, (x, y))
-
-    else:
-        for i, tile in enumerate(tiles):
-            x = (i % 16) * 8
-            y = (i // 16) * 8
-            tileset_image.paste(tile, (x, y))
-
-    tileset_image.save(output_path)
+    tileset_pixels = np.full((height, 128, 3), 255, dtype=np.uint8)
+    tileset_tiles = split_into_blocks(tileset_pixels, 8)
 
+    for i, tile in enumerate(tiles):
+        if len(tiles) > 192 and i == 127:
+            new_tile = (0, 255, 255)  # Space tile
+        elif grayscale:
+            new_tile = tile_to_grayscale(tile)
+        else:
+            new_tile = tile_to_color(tile, color_to_grays[i])
+        tileset_tiles[i // 16, i % 16] = new_tile
 
-def save_metatiles_bin_file(metatiles, tiles, output_path):
-    with open(output_path, 'wb') as f:
-        for metatile in metatiles:
-            for y in range(0, 32, 8):
-                for x in range(0, 32, 8):
-                    tile = metatile.crop((x, y, x + 8, y + 8))
-                    tile_index = tiles.index(tile)
+    Image.fromarray(tileset_pixels).save(output_path)
 
-                    # ? The space tile can't be used in any metatiles
-                    if len(tiles) > 192 and tile_index == 127:
-                        tile_index = tiles.index(tile, 128)
 
-                    f.write(tile_index.to_bytes(1, 'big'))
+@profiled
+def save_metatiles_bin_file(metatile_tiles, output_path):
+    write_bin_file(output_path, metatile_tiles)
 
 
+@profiled
 def save_palette_map_asm_file(colors, output_path):
     vram_area_tiles = 96
     if len(colors) > 192:
@@ -1191,192 +1713,766 @@ def save_palette_map_asm_file(colors, output_path):
 # ablk ------------------------------------------------------------------------
 
 
+@profiled
 def save_compressed_tileset_image(tiles, output_path):
     num_rows = (len(tiles) + 15) // 16
     height = num_rows * 8
 
-    tileset_image = Image.new('RGB', (128, height), (255, 255, 255))
+    tileset_pixels = np.full((height, 128, 3), 255, dtype=np.uint8)
+    tileset_tiles = split_into_blocks(tileset_pixels, 8)
 
     for i, tile in enumerate(tiles):
-        x = (i % 16) * 8
-        y = (i // 16) * 8
-        tileset_image.paste(tile, (x, y))
+        if len(tiles) > 128 and i == 127:
+            tileset_tiles[i // 16, i % 16] = (0, 255, 255)  # Space tile
+        else:
+            tileset_tiles[i // 16, i % 16] = tile_to_grayscale(tile)
 
-    tileset_image.save(output_path)
+    Image.fromarray(tileset_pixels).save(output_path)
 
 
+@profiled
 def save_attr_metatiles_bin_file(attr_metatiles, output_path):
-    with open(output_path, 'wb') as f:
-        for metatile_info in attr_metatiles:
-            for compressed_index, color, flip_x, flip_y in metatile_info:
-                f.write(bytes([compressed_index % 0x80]))
+    write_bin_file(output_path, bytes(compressed_index % 0x80
+                                      for metatile_info in attr_metatiles
+                                      for compressed_index, _, _, _ in metatile_info))
 
 
+@profiled
 def save_attributes_bin_file(attr_metatiles, palettes, output_path):
-    with open(output_path, 'wb') as f:
-        for metatile_info in attr_metatiles:
-            for compressed_index, color, flip_x, flip_y in metatile_info:
-                color_index = list(palettes['morn'].keys()).index(color)
-                attributes = color_index & 0x07
-                if compressed_index >= 0x80:
-                    attributes |= 0x08  # Set bank 1
-                if flip_x:
-                    attributes |= 0x20
-                if flip_y:
-                    attributes |= 0x40
-                f.write(bytes([attributes]))
+    color_indexes = {color: i for i, color in enumerate(palettes['morn'])}
+    data = bytearray()
+    for metatile_info in attr_metatiles:
+        for compressed_index, color, flip_x, flip_y in metatile_info:
+            attributes = color_indexes[color] & 0x07
+            if compressed_index >= 0x80:
+                attributes |= 0x08  # Set bank 1
+            if flip_x:
+                attributes |= 0x20
+            if flip_y:
+                attributes |= 0x40
+            data.append(attributes)
+    write_bin_file(output_path, data)
 
 
-# -----------------------------------------------------------------------------
+# CACHE -----------------------------------------------------------------------
 
 
-def main():
-    palettes_8bit_rgb = palettes_to_8bit_rgb(palettes)
+cache_dir_name = '.metatiled-cache'
 
-    parser = argparse.ArgumentParser(
-        description='Convert an image (PNG) to a map.')
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('map_image', type=str, nargs='?', default=None,
-                       help='Name of the map image file (PNG).')
-    group.add_argument('--merge', '-m', action='store_true',
-                       help='Merge tilesets along with their related files.')
 
-    parser.add_argument('--palette', '-p', type=str,
-                        help='Specify palette to use (avoid auto-detect).')
-    parser.add_argument('--compress', '-c', action='store_true',
-                        help='Apply additional compression to tiles.')
-    parser.add_argument('--extract-palette', '-e', action='store_true',
-                        help='Extract the palette from the image.')
-    parser.add_argument('--analyze-palette', '-a', action='store_true',
-                        help='Validate the palette; if invalid, output a guiding image.')
+def get_cache_key(map_path, **options):
+    '''Hash of everything that affects the outputs of a map.'''
+    key = hashlib.sha256()
 
-    args = parser.parse_args()
+    # Tool version
+    with open(os.path.abspath(__file__), 'rb') as f:
+        key.update(f.read())
 
-    map_path = args.map_image
-    palette_name = args.palette
-    merge = args.merge
-    compress = args.compress
-    extract_palette = args.extract_palette
-    analyze_palette = args.analyze_palette
+    key.update(os.path.basename(map_path).encode())
+    input_paths = [
+        map_path,
+        map_path.replace('.png', '.txt'),
+        map_path.replace('.png', '_collision.png')
+    ]
+    for input_path in input_paths:
+        if os.path.exists(input_path):
+            with open(input_path, 'rb') as f:
+                key.update(hashlib.sha256(f.read()).digest())
+        else:
+            key.update(b'-')
 
-    base_dir = os.path.dirname(os.path.abspath(__file__))
+    key.update(repr(sorted(options.items())).encode())
+    return key.hexdigest()
 
-    if merge:
-        data_dir, gfx_dir, map_dir = process_directories(base_dir)
-        if not compress:
-            base_tileset_index, tiles_index_mappings = merge_blk_tilesets(
-                gfx_dir)
-            metatiles_index_mappings = merge_blk_metatiles(
-                data_dir, base_tileset_index, tiles_index_mappings)
-            merge_maps(map_dir, base_tileset_index,
-                       metatiles_index_mappings)
-        else:
-            base_tileset_index, tiles_index_mappings = merge_ablk_tilesets(
-                gfx_dir)
-            metatiles_index_mappings = merge_ablk_metatiles(
-                data_dir, base_tileset_index, tiles_index_mappings)
-            merge_maps(map_dir, base_tileset_index,
-                       metatiles_index_mappings, ablk=True)
-        print('Merged!')
-        return
 
-    base_name = os.path.splitext(os.path.basename(map_path))[0]
+def restore_from_cache(base_dir, cache_key):
+    entry_dir = os.path.join(base_dir, cache_dir_name, cache_key)
+    manifest_path = os.path.join(entry_dir, 'outputs.txt')
+    if not os.path.exists(manifest_path):
+        return False
 
-    if analyze_palette:
-        analyze(map_path)
+    with open(manifest_path, 'r') as f:
+        outputs = f.read().split('\n')
+
+    for output in filter(None, outputs):
+        shutil.copy(os.path.join(entry_dir, output),
+                    os.path.join(base_dir, output))
+    return True
+
+
+def store_in_cache(base_dir, cache_key, outputs):
+    cache_dir = os.path.join(base_dir, cache_dir_name)
+    entry_dir = os.path.join(cache_dir, cache_key)
+    if os.path.exists(entry_dir):
         return
 
-    process_directories(base_dir, create=True)
+    # Fill a temporary directory first so other processes never see a partial entry
+    tmp_dir = os.path.join(cache_dir, f'{cache_key}.{os.getpid()}.tmp')
+    relative_outputs = [os.path.relpath(output, base_dir) for output in outputs]
+    for output in relative_outputs:
+        os.makedirs(os.path.join(tmp_dir, os.path.dirname(output)), exist_ok=True)
+        shutil.copy(os.path.join(base_dir, output),
+                    os.path.join(tmp_dir, output))
+    with open(os.path.join(tmp_dir, 'outputs.txt'), 'w') as f:
+        f.write('\n'.join(relative_outputs))
 
-    palette = palettes_8bit_rgb[palette_name] if palette_name else None
-    palette = 'extract' if extract_palette else palette
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    info = load_info(map_path)
 
-    custom_palette = info[0] if info and not palette else None
-    collision_colors = info[1] if info else None
+# STATE -----------------------------------------------------------------------
 
-    if custom_palette:
-        palettes_8bit_rgb['custom'] = custom_palette
-        palette = custom_palette
 
-        pal_file_path = os.path.join(
-            base_dir, 'gfx', 'tilesets', f'{base_name}.pal')
-        save_pal_file(pal_file_path, palette, compress)
+state_version = 1  # Increase it when the contents of the state files change
+
+
+def get_state_path(map_path):
+    return map_path.replace('.png', '_state.npz')
 
-    map_image = Image.open(map_path).convert("RGB")  # Remove transparency
-    darkest_tone = sort_color(list(set(map_image.getdata())))[-1]
+
+def load_state_file(state_path):
+    '''State of the last incremental conversion of a map ({} if there isn't a valid one).'''
+    if not os.path.exists(state_path):
+        return {}
+    try:
+        with np.load(state_path) as data:
+            state = {key: data[key] for key in data.files}
+    except (OSError, ValueError):
+        print('Invalid state file, converting from scratch!')
+        return {}
+    if state.pop('version', None) != state_version:
+        return {}
+    return state
+
+
+@profiled
+def save_state_file(state_path, state):
+    '''Cell hashes, unique metatiles, metatile indexes and tiles of a conversion.'''
+    np.savez_compressed(state_path, version=state_version, **state)
+
+
+# CONVERT ---------------------------------------------------------------------
+
+
+# Everything needed to write the files of a converted map
+ConversionResult = namedtuple('ConversionResult', [
+    'compress',
+    'metatile_indexes',  # Map (.blk/.ablk)
+    'tiles',  # Tiles of the tileset (compressed ones with compress)
+    'color_to_grays',  # Gray of every tone of every tile (without compress)
+    'metatile_tiles',  # Tile indexes of every metatile (before compression)
+    'palette_map',  # Color of every tile (without compress, None if monochrome)
+    'attr_metatiles',  # (tile index, color, flip_x, flip_y) of every tile of every metatile (with compress)
+    'collisions',  # 4 collision names of every metatile (None without collisions)
+    'custom_palette',  # Palette for the .pal file (None if not custom)
+    'log',  # Console output
+    'state'  # State for the next conversion (None if not incremental)
+])
+
+
+def load_unique_metatiles(image, stream=False, state=None, log=None):
+    if stream:
+        if isinstance(image, Image.Image):
+            raise ConversionError('[Error] Streaming needs the path of the map image.')
+        return stream_unique_metatiles(image, log)
+    map_image, darkest_tone = load_map_image(image)
     metatiles, positions = divide_into_metatiles(map_image)
-    unique_metatiles, metatile_positions, metatile_indexes = identify_unique_metatiles(
-        metatiles, positions, darkest_tone)
-    tiles, tile_color_names, color_to_grays, monochrome = identify_unique_tiles(
-        unique_metatiles, metatile_positions, palettes_8bit_rgb, palette)
+    if state is not None:
+        return restore_unique_metatiles(metatiles, positions, darkest_tone, state, log)
+    if warm_cache is not None and isinstance(image, str):
+        return update_unique_metatiles(image, metatiles, positions, darkest_tone, log)
+    return identify_unique_metatiles(metatiles, positions, darkest_tone, log)
+
+
+class LogStream(io.StringIO):
+    '''Console output kept in memory and also written to a stream as it's produced.'''
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text)
+        return super().write(text)
+
+
+def convert(image, palette=None, compress=False, collision_colors=None, collision_mask=None,
+            stream=False, workers=None, log=None, state=None):
+    '''Convert a map image (a path or a PIL image) without writing any files.
+
+    palette is the name of a default palette or a custom one ({color name: tones});
+    it's detected if None. Collisions need collision_colors ({'#rrggbb': name}) and
+    collision_mask (a path or a PIL image). The console output is kept in the log of
+    the result (and also written to the log stream as it's produced, e.g.
+    sys.stdout). Maps that can't be converted raise ConversionError.
+
+    state is the state of the last conversion of the map ({} for the first one):
+    only the metatiles that changed are looked up, and metatiles and tiles keep
+    their indexes when possible. The new state is returned with the result.
+    '''
+    if state is not None:
+        if stream:
+            raise ConversionError('[Error] Incremental conversions can\'t be streamed.')
+        state = dict(state)
+        tile_registry = [tile.tobytes() for tile in state.get('tiles', [])]
+    else:
+        tile_registry = None
+
+    palettes_8bit_rgb = load_palettes()
+    custom_palette = None
+    if isinstance(palette, str):
+        if palette not in palettes_8bit_rgb:
+            raise ConversionError(f'[Error] Unknown palette {palette}.')
+        palette = dict(palettes_8bit_rgb[palette])  # ? The roof tones are replaced
+    elif palette:
+        custom_palette = palette
+        palette = dict(palette)  # ? The roof tones are replaced
+
+    output = io.StringIO() if log is None else LogStream(log)
+    unique_metatiles, metatile_positions, metatile_indexes = load_unique_metatiles(
+        image, stream, state, output)
+    tiles, color_to_grays, metatile_tiles, monochrome = identify_unique_tiles(
+        unique_metatiles, metatile_positions, palettes_8bit_rgb, palette, workers,
+        tile_registry, output)
+    if state is not None:
+        state['tiles'] = np.frombuffer(
+            b''.join(tile_registry), dtype=np.uint8).reshape(-1, 8, 8, 3)
+
+    collisions = None
+    if collision_colors and collision_mask is not None:
+        collision_grid = load_collision_grid(collision_mask, stream)
+        collisions = get_metatile_collisions(
+            collision_grid, collision_colors, metatile_positions)
+
+    palette_map = None
+    attr_metatiles = None
+    if not compress:
+        if not monochrome:
+            palette_map = [tile.color for tile in tiles]
+    else:
+        tiles, transformations = compress_tiles(tiles, output)
+        attr_metatiles = get_attr_metatiles(metatile_tiles, transformations)
+        color_to_grays = None
 
-    if extract_palette:
-        palette_colors = tiles
-        save_palette_txt_file(map_path, palette_colors)
+    return ConversionResult(compress, metatile_indexes, tiles, color_to_grays, metatile_tiles,
+                            palette_map, attr_metatiles, collisions, custom_palette, output.getvalue(),
+                            state)
 
-        print('Done!')
-        return
 
-    if collision_colors:
-        collision_mask = Image.open(map_path.replace(
-            '.png', '_collision.png')).convert('RGB')
+def emit(result, base_dir, base_name):
+    '''Write the files of a converted map into the project at base_dir, returning their paths.'''
+    process_directories(base_dir, create=True)
+    map_name = ''.join([word.capitalize() for word in base_name.split('_')])
+    outputs = []
+
+    if result.custom_palette:
+        pal_file_path = os.path.join(
+            base_dir, 'gfx', 'tilesets', f'{base_name}.pal')
+        save_pal_file(pal_file_path, result.custom_palette, result.compress)
+        outputs.append(pal_file_path)
+
+    if result.collisions is not None:
         collision_asm_path = os.path.join(
             base_dir, 'data', 'tilesets', f'{base_name}_collision.asm')
-        save_collision_asm_file(
-            collision_mask, collision_colors, metatile_positions, collision_asm_path)
+        save_collision_asm_file(result.collisions, collision_asm_path)
+        outputs.append(collision_asm_path)
 
-    if not compress:
+    if not result.compress:
         ensure_file(base_dir, 'Makefile')
 
-        blk_file_name = ''.join([word.capitalize()
-                                for word in base_name.split('_')]) + '.blk'
-        blk_file_path = os.path.join(base_dir, 'maps', blk_file_name)
-        save_blk_file(blk_file_path, metatile_indexes)
+        blk_file_path = os.path.join(base_dir, 'maps', f'{map_name}.blk')
+        save_blk_file(blk_file_path, result.metatile_indexes)
+        outputs.append(blk_file_path)
 
         tileset_image_path = os.path.join(
             base_dir, 'gfx', 'tilesets', f'{base_name}.png')
-        save_tileset_image(tiles, color_to_grays,
+        save_tileset_image(result.tiles, result.color_to_grays,
                            tileset_image_path, grayscale=True)
+        outputs.append(tileset_image_path)
 
         metatiles_binary_path = os.path.join(
             base_dir, 'data', 'tilesets', f'{base_name}_metatiles.bin')
-        save_metatiles_bin_file(unique_metatiles, tiles, metatiles_binary_path)
+        save_metatiles_bin_file(result.metatile_tiles, metatiles_binary_path)
+        outputs.append(metatiles_binary_path)
 
-        if not monochrome:
+        if result.palette_map:
             asm_file_path = os.path.join(
                 base_dir, 'gfx', 'tilesets', f'{base_name}_palette_map.asm')
-            save_palette_map_asm_file(tile_color_names, asm_file_path)
+            save_palette_map_asm_file(result.palette_map, asm_file_path)
+            outputs.append(asm_file_path)
     else:
-        compressed_tiles, transformations = compress_tiles(
-            tiles, tile_color_names, color_to_grays)
-        attr_metatiles = get_attr_metatiles(
-            unique_metatiles, compressed_tiles, transformations, color_to_grays)
-
         ensure_file(base_dir, 'Main.asm')
 
         compressed_tileset_image_path = os.path.join(
             base_dir, 'gfx', 'tilesets', f'{base_name}.png')
         save_compressed_tileset_image(
-            compressed_tiles, compressed_tileset_image_path)
+            result.tiles, compressed_tileset_image_path)
+        outputs.append(compressed_tileset_image_path)
 
         metatiles_binary_path = os.path.join(
             base_dir, 'data', 'tilesets', f'{base_name}_metatiles.bin')
-        save_attr_metatiles_bin_file(attr_metatiles, metatiles_binary_path)
+        save_attr_metatiles_bin_file(result.attr_metatiles, metatiles_binary_path)
+        outputs.append(metatiles_binary_path)
 
         attributes_binary_path = os.path.join(
             base_dir, 'data', 'tilesets', f'{base_name}_attributes.bin')
         save_attributes_bin_file(
-            attr_metatiles, palettes_8bit_rgb, attributes_binary_path)
+            result.attr_metatiles, palettes, attributes_binary_path)
+        outputs.append(attributes_binary_path)
+
+        ablk_file_path = os.path.join(base_dir, 'maps', f'{map_name}.ablk')
+        save_blk_file(ablk_file_path, result.metatile_indexes)
+        outputs.append(ablk_file_path)
+
+    return outputs
 
-        ablk_file_name = ''.join([word.capitalize()
-                                  for word in base_name.split('_')]) + '.ablk'
-        ablk_file_path = os.path.join(base_dir, 'maps', ablk_file_name)
-        save_blk_file(ablk_file_path, metatile_indexes)
+
+def load_map_info(map_path, palette_name=None, log=None):
+    '''Palette (its name or the custom one of the txt file) and collisions (colors and mask) of a map.'''
+    info = load_info(map_path, log)
+    custom_palette = info[0] if info and not palette_name else None
+    collision_colors = info[1] if info else None
+    collision_mask = map_path.replace(
+        '.png', '_collision.png') if collision_colors else None
+    return custom_palette or palette_name, collision_colors, collision_mask
+
+
+def convert_map(map_path, base_dir, palette_name=None, compress=False, extract_palette=False, cache=False,
+                stream=False, workers=None, incremental=False):
+    base_name = os.path.splitext(os.path.basename(map_path))[0]
+
+    process_directories(base_dir, create=True)
+
+    # ? The extracted palette is written next to the map, so it isn't cached
+    # ? Incremental outputs depend on the previous conversion too, so they aren't cached either
+    cache_key = None
+    if cache and not extract_palette and not incremental:
+        cache_key = get_cache_key(
+            map_path, palette_name=palette_name, compress=compress)
+        if restore_from_cache(base_dir, cache_key):
+            count('cache hits')
+            ensure_file(base_dir, 'Main.asm' if compress else 'Makefile')
+            print('Unchanged, restored from cache!')
+            return
+        count('cache misses')
+
+    palette, collision_colors, collision_mask = load_map_info(map_path, palette_name)
+
+    if extract_palette:
+        unique_metatiles, metatile_positions, _ = load_unique_metatiles(
+            map_path, stream)
+        palette_colors, _, _, _ = identify_unique_tiles(
+            unique_metatiles, metatile_positions, load_palettes(), 'extract', workers)
+        save_palette_txt_file(map_path, palette_colors)
+
+        print('Done!')
+        return
+
+    state = load_state_file(get_state_path(map_path)) if incremental else None
+    result = convert(map_path, palette, compress, collision_colors,
+                     collision_mask, stream, workers, log=sys.stdout, state=state)
+    outputs = emit(result, base_dir, base_name)
+    if incremental:
+        save_state_file(get_state_path(map_path), result.state)
+
+    if cache_key:
+        store_in_cache(base_dir, cache_key, outputs)
 
     print('Done!')
 
 
+def find_map_images(pattern):
+    '''Map images in a directory or matching a glob pattern.'''
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, f) for f in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+
+    # Skip collision masks and analysis outputs
+    suffixes = ('_collision.png', '_coll.png', '_analysis.png')
+    return sorted(path for path in paths
+                  if path.endswith('.png') and not path.endswith(suffixes))
+
+
+def run_map(map_path, base_dir, analyze_palette=False, profile=False, **options):
+    '''Process one map capturing its console output (used by batch mode).'''
+    if profile:
+        enable_profile()
+
+    output = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            if analyze_palette:
+                analyze(map_path)
+            else:
+                convert_map(map_path, base_dir, **options)
+        except (SystemExit, ConversionError) as e:
+            error = str(e)
+        except Exception as e:
+            error = f'[Error] {type(e).__name__}: {e}'
+    return map_path, output.getvalue(), error, profile_stats if profile else None
+
+
+def convert_maps(map_paths, base_dir, jobs=None, **options):
+    '''Convert several maps, returning their merged profile when profiling
+    and the number of maps that failed.'''
+    # ? Created before the workers start so they don't race to create them
+    process_directories(base_dir, create=True)
+
+    if jobs == 1:
+        results = [run_map(map_path, base_dir, **options)
+                   for map_path in map_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(run_map, map_path, base_dir, **options)
+                       for map_path in map_paths]
+            results = [future.result() for future in futures]
+
+    failed = 0
+    total_stats = None
+    for map_path, output, error, stats in results:
+        print(f'[{os.path.basename(map_path)}]')
+        print(output, end='')
+        if error:
+            print(error)
+            failed += 1
+        print()
+
+        if stats:
+            if total_stats is None:
+                total_stats = {'stages': {}, 'counters': {}, 'maps': {}}
+            merge_profile(total_stats, stats)
+            total_stats['maps'][os.path.basename(map_path)] = stats
+
+    print(f'Maps: {len(results)} ({len(results) - failed} done, {failed} failed)')
+    return total_stats, failed
+
+
+# SERVE -----------------------------------------------------------------------
+
+
+def handle_request(request, output_root):
+    '''Convert (or analyze) the map of a request, returning the response.
+
+    The files (or the analysis image) are written to the output directory of the
+    request (relative to output_root, and never outside it); without it, the
+    converted data (or the image as base64 PNG) is returned instead.
+    '''
+    map_path = request['map']
+    output = io.StringIO()
+    response = {}
+    try:
+        output_dir = None
+        if request.get('output'):
+            output_dir = os.path.realpath(os.path.join(output_root, request['output']))
+            if os.path.commonpath([output_root, output_dir]) != output_root:
+                raise ConversionError(f'[Error] The output must be inside {output_root}.')
+        base_name = os.path.splitext(os.path.basename(map_path))[0]
+
+        if request.get('analyze'):
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+                analysis_path = os.path.join(output_dir, f'{base_name}_analysis.png')
+                analyze(map_path, output, analysis_path)
+                response['outputs'] = [analysis_path]
+            else:
+                image = io.BytesIO()
+                analyze(map_path, output, image)
+                response['analysis'] = base64.b64encode(image.getvalue()).decode()
+        else:
+            compress = bool(request.get('compress'))
+            palette, collision_colors, collision_mask = load_map_info(
+                map_path, request.get('palette'), output)
+            result = convert(map_path, palette, compress, collision_colors, collision_mask,
+                             request.get('stream', False), log=output)
+            if output_dir:
+                response['outputs'] = emit(result, output_dir, base_name)
+            else:
+                response.update(
+                    map=result.metatile_indexes,
+                    tiles=[{'data': tile.data.hex(), 'color': tile.color}
+                           for tile in result.tiles],
+                    metatiles=result.attr_metatiles if compress else result.metatile_tiles,
+                    palette_map=result.palette_map,
+                    collisions=result.collisions)
+    except ConversionError as e:
+        response['error'] = str(e)
+    except Exception as e:
+        response['error'] = f'[Error] {type(e).__name__}: {e}'
+    response['log'] = output.getvalue()
+    return response
+
+
+class ServeHandler(http.server.BaseHTTPRequestHandler):
+    '''POST a JSON request ({"map": path, "palette", "compress", "analyze", "output"}).'''
+
+    def do_POST(self):
+        start = time.perf_counter()
+        # ? Browsers add an Origin header and can't send JSON cross-origin without
+        # ? a preflight, so web pages can't make the server write files
+        if self.headers.get('Origin') is not None:
+            self.send_error(403, 'Requests from web pages are not allowed')
+            return
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.send_error(415, 'Expected Content-Type: application/json')
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            map_path = request['map']
+        except (ValueError, TypeError, KeyError):
+            self.send_error(400, 'Expected a JSON object with the path of the map')
+            return
+
+        response = handle_request(request, self.server.output_root)
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f'{map_path}: {"failed" if "error" in response else "done"} ({elapsed:.1f} ms)')
+
+    def log_message(self, format, *args):
+        pass  # ? Every request is already reported
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)  # ? The handler expects a (host, port) client address
+
+
+def serve(address, output_root):
+    '''Convert maps on request, keeping palettes and tiles warm between conversions.
+
+    address is a port (localhost) or the path of a Unix socket. Files are only
+    written inside output_root.
+    '''
+    if not os.path.isdir(output_root):
+        raise SystemExit(f'[Error] {output_root} is not a directory.')
+
+    enable_warm_cache()
+    if address.isdigit():
+        server = http.server.HTTPServer(('127.0.0.1', int(address)), ServeHandler)
+        print(f'Serving on http://127.0.0.1:{server.server_port}')
+    else:
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)  # ? Left by a previous server
+        server = UnixHTTPServer(address, ServeHandler)
+        print(f'Serving on {address}')
+    server.output_root = os.path.realpath(output_root)
+    print(f'Writing files inside {server.output_root}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not address.isdigit() and os.path.exists(address):
+            os.remove(address)
+
+
+# WATCH -----------------------------------------------------------------------
+
+
+watch_interval = 0.5  # Seconds between polls
+
+
+def get_map_stamp(map_path):
+    '''Modification time and size of a map, its txt file and its collision mask.'''
+    stamp = []
+    for file_path in (map_path, map_path.replace('.png', '.txt'),
+                      map_path.replace('.png', '_collision.png')):
+        try:
+            file_stat = os.stat(file_path)
+            stamp.append((file_stat.st_mtime_ns, file_stat.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return stamp
+
+
+def watch(watch_dir, base_dir, **options):
+    '''Convert every map of a directory whenever it (or its txt file or collision mask) changes.'''
+    if not os.path.isdir(watch_dir):
+        raise SystemExit(f'[Error] {watch_dir} is not a directory.')
+
+    enable_warm_cache()
+    stamps = {}
+    print(f'Watching {watch_dir}')
+    try:
+        while True:
+            map_paths = find_map_images(watch_dir)
+            for map_path in set(stamps) - set(map_paths):
+                del stamps[map_path]
+                warm_cache['maps'].pop(map_path, None)
+
+            for map_path in map_paths:
+                stamp = get_map_stamp(map_path)
+                if stamps.get(map_path) == stamp:
+                    continue
+                stamps[map_path] = stamp
+
+                print(f'[{os.path.basename(map_path)}]')
+                try:
+                    convert_map(map_path, base_dir, **options)
+                except (SystemExit, ConversionError) as e:
+                    print(e)
+                except Exception as e:
+                    # ? The image may be read while it's still being saved; it's converted again once saved
+                    print(f'[Error] {type(e).__name__}: {e}')
+                print()
+            time.sleep(watch_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+# -----------------------------------------------------------------------------
+
+
+def positive_int(value):
+    '''Type of the arguments that count processes.'''
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert an image (PNG) to a map.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('map_image', type=str, nargs='?', default=None,
+                       help='Name of the map image file (PNG), a directory or a glob pattern.')
+    group.add_argument('--merge', '-m', action='store_true',
+                       help='Merge tilesets along with their related files.')
+    group.add_argument('--serve', type=str, metavar='ADDRESS',
+                       help='Convert maps on request at a localhost port or a Unix socket.')
+    group.add_argument('--watch', type=str, metavar='DIR',
+                       help='Convert the maps of a directory again whenever they change.')
+
+    parser.add_argument('--serve-root', type=str, metavar='DIR',
+                        help='Directory the output of --serve requests must be inside (defaults to this one).')
+    parser.add_argument('--palette', '-p', type=str,
+                        help='Specify palette to use (avoid auto-detect).')
+    parser.add_argument('--compress', '-c', action='store_true',
+                        help='Apply additional compression to tiles.')
+    parser.add_argument('--extract-palette', '-e', action='store_true',
+                        help='Extract the palette from the image.')
+    parser.add_argument('--analyze-palette', '-a', action='store_true',
+                        help='Validate the palette; if invalid, output a guiding image.')
+    parser.add_argument('--jobs', '-j', type=positive_int,
+                        help='Number of processes used to convert several maps.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Show time, peak memory and counters of every stage.')
+    parser.add_argument('--profile-json', type=str, metavar='PATH',
+                        help='Save the profile as JSON (implies --profile).')
+    parser.add_argument('--cache', action='store_true',
+                        help=f'Skip unchanged maps restoring their files from {cache_dir_name}.')
+    parser.add_argument('--workers', '-w', type=positive_int,
+                        help='Number of processes used to extract the tiles of every map.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the map one band of metatiles at a time to save memory.')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='Only look up the metatiles that changed, keeping the indexes of the rest.')
+
+    args = parser.parse_args()
+
+    map_path = args.map_image
+    palette_name = args.palette
+    merge = args.merge
+    compress = args.compress
+    extract_palette = args.extract_palette
+    analyze_palette = args.analyze_palette
+    jobs = args.jobs
+    cache = args.cache
+    stream = args.stream
+    workers = args.workers
+    incremental = args.incremental
+    profile = args.profile or bool(args.profile_json)
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    if args.serve:
+        serve(args.serve, args.serve_root or base_dir)
+        return
+
+    if args.watch:
+        watch(args.watch, base_dir, palette_name=palette_name, compress=compress,
+              cache=cache, stream=stream, workers=workers, incremental=incremental)
+        return
+
+    if profile:
+        enable_profile()
+
+    try:
+        stats, failed = run_command(map_path, base_dir, merge, jobs, palette_name, compress,
+                                    extract_palette, analyze_palette, cache, profile, stream,
+                                    workers, incremental)
+    except ConversionError as e:
+        raise SystemExit(str(e)) from None
+
+    if profile:
+        print()
+        print_profile(stats)
+        if args.profile_json:
+            save_profile_json_file(stats, args.profile_json)
+
+    if failed:
+        sys.exit(1)
+
+
+def run_command(map_path, base_dir, merge=False, jobs=None, palette_name=None, compress=False,
+                extract_palette=False, analyze_palette=False, cache=False, profile=False,
+                stream=False, workers=None, incremental=False):
+    '''Run the command, returning the collected profile and the number of maps that failed.'''
+    if merge:
+        manifest = build_merge_manifest(base_dir, ablk=compress)
+        if not compress:
+            base_tileset_index, tiles_index_mappings = merge_blk_tilesets(
+                manifest)
+            metatiles_index_mappings = merge_blk_metatiles(
+                manifest, base_tileset_index, tiles_index_mappings)
+            merge_maps(manifest, base_tileset_index,
+                       metatiles_index_mappings)
+        else:
+            base_tileset_index, tiles_index_mappings = merge_ablk_tilesets(
+                manifest)
+            metatiles_index_mappings = merge_ablk_metatiles(
+                manifest, base_tileset_index, tiles_index_mappings)
+            merge_maps(manifest, base_tileset_index,
+                       metatiles_index_mappings, ablk=True)
+        print('Merged!')
+        return profile_stats, 0
+
+    if not map_path.endswith('.png') or not os.path.isfile(map_path):
+        map_paths = find_map_images(map_path)
+        if not map_paths:
+            raise SystemExit(f'[Error] No map images found in {map_path}.')
+        return convert_maps(map_paths, base_dir, jobs=jobs, analyze_palette=analyze_palette,
+                            palette_name=palette_name, compress=compress,
+                            extract_palette=extract_palette, cache=cache, profile=profile,
+                            stream=stream, workers=workers, incremental=incremental)
+
+    if analyze_palette:
+        analyze(map_path)
+        return profile_stats, 0
+
+    convert_map(map_path, base_dir, palette_name,
+                compress, extract_palette, cache, stream, workers, incremental)
+    return profile_stats, 0
+
+
 if __name__ == "__main__":
     main()